@@ -88,8 +88,78 @@ def create_app(test_config=None):
         DEV_MODE=env_bool("DEV_MODE"),
         DEV_MODE_ENC_PW=os.environ.get("DEV_MODE_ENC_PW"),
         NOTIFICATION_TASK_DELAY=int(os.environ.get("NOTIFICATION_TASK_DELAY", 60)),
+        WALLETNOTIFY_ASYNC=env_bool("WALLETNOTIFY_ASYNC"),
+        WALLETNOTIFY_WORKERS=int(os.environ.get("WALLETNOTIFY_WORKERS", 4)),
+        WALLETNOTIFY_RETRY_BASE=int(os.environ.get("WALLETNOTIFY_RETRY_BASE", 30)),
+        WALLETNOTIFY_RETRY_MAX=int(os.environ.get("WALLETNOTIFY_RETRY_MAX", 3600)),
+        WALLETNOTIFY_CACHE_SIZE=int(os.environ.get("WALLETNOTIFY_CACHE_SIZE", 100000)),
+        WALLETNOTIFY_UNRELATED_TTL=int(
+            os.environ.get("WALLETNOTIFY_UNRELATED_TTL", 3600)
+        ),
+        WALLETNOTIFY_SWEEP_BATCH=int(os.environ.get("WALLETNOTIFY_SWEEP_BATCH", 500)),
+        CONFIRMATION_POLL_MIN=int(os.environ.get("CONFIRMATION_POLL_MIN", 5)),
+        CONFIRMATION_POLL_MAX=int(os.environ.get("CONFIRMATION_POLL_MAX", 300)),
+        CONFIRMATION_POLL_DEFAULT=int(os.environ.get("CONFIRMATION_POLL_DEFAULT", 60)),
+        WEBHOOK_WORKERS=int(os.environ.get("WEBHOOK_WORKERS", 16)),
+        WEBHOOK_HOST_CONCURRENCY=int(os.environ.get("WEBHOOK_HOST_CONCURRENCY", 2)),
+        WEBHOOK_CYCLE_DEADLINE=int(os.environ.get("WEBHOOK_CYCLE_DEADLINE", 50)),
+        WEBHOOK_RETRY_BASE=int(os.environ.get("WEBHOOK_RETRY_BASE", 30)),
+        WEBHOOK_RETRY_MAX=int(os.environ.get("WEBHOOK_RETRY_MAX", 3600)),
+        WEBHOOK_OUTBOX_BATCH=int(os.environ.get("WEBHOOK_OUTBOX_BATCH", 500)),
+        WEBHOOK_MERCHANT_BATCH=int(os.environ.get("WEBHOOK_MERCHANT_BATCH", 50)),
+        WEBHOOK_PRIORITIZE_PAID=env_bool("WEBHOOK_PRIORITIZE_PAID", True),
+        WEBHOOK_BATCH_WINDOW=int(os.environ.get("WEBHOOK_BATCH_WINDOW", 5)),
+        WEBHOOK_BATCH_MAX=int(os.environ.get("WEBHOOK_BATCH_MAX", 100)),
+        WEBHOOK_POOL_MAXSIZE=int(os.environ.get("WEBHOOK_POOL_MAXSIZE", 4)),
+        WEBHOOK_POOL_IDLE_TIMEOUT=int(os.environ.get("WEBHOOK_POOL_IDLE_TIMEOUT", 120)),
+        EVENTS_MAX_WAIT=int(os.environ.get("EVENTS_MAX_WAIT", 30)),
+        EVENTS_POLL_INTERVAL=float(os.environ.get("EVENTS_POLL_INTERVAL", 1)),
+        EVENTS_MAX_WAITERS=int(os.environ.get("EVENTS_MAX_WAITERS", 8)),
+        WEBHOOK_BREAKER_THRESHOLD=int(os.environ.get("WEBHOOK_BREAKER_THRESHOLD", 5)),
+        WEBHOOK_BREAKER_COOLDOWN=int(os.environ.get("WEBHOOK_BREAKER_COOLDOWN", 300)),
         TEMPLATES_AUTO_RELOAD=True,
         DISABLE_CRYPTO_WHEN_LAGS=env_bool("DISABLE_CRYPTO_WHEN_LAGS"),
+        RATE_CACHE_TTL=int(os.environ.get("RATE_CACHE_TTL", 30)),
+        RATE_CACHE_STALE_TTL=int(os.environ.get("RATE_CACHE_STALE_TTL", 300)),
+        RATE_CACHE_REFRESH_INTERVAL=int(
+            os.environ.get("RATE_CACHE_REFRESH_INTERVAL", 20)
+        ),
+        FIAT_CURRENCIES=[
+            fiat.strip().upper()
+            for fiat in os.environ.get("FIAT_CURRENCIES", "USD,EUR").split(",")
+            if fiat.strip()
+        ],
+        RATE_CROSS_FIAT=env_bool("RATE_CROSS_FIAT"),
+        RATE_BASE_FIAT=os.environ.get("RATE_BASE_FIAT", "USD"),
+        FX_REFRESH_INTERVAL=int(os.environ.get("FX_REFRESH_INTERVAL", 3600)),
+        FX_MANUAL_RATES=os.environ.get("FX_MANUAL_RATES", ""),
+        RATE_STREAM_SOURCES=[
+            name.strip()
+            for name in os.environ.get("RATE_STREAM_SOURCES", "").split(",")
+            if name.strip()
+        ],
+        RATE_STREAM_WS_URLS={
+            name.strip(): os.environ[f"{name.strip().upper()}_WS_URL"]
+            for name in os.environ.get("RATE_STREAM_SOURCES", "").split(",")
+            if f"{name.strip().upper()}_WS_URL" in os.environ
+        },
+        RATE_STREAM_MAX_AGE=int(os.environ.get("RATE_STREAM_MAX_AGE", 30)),
+        RATE_COMPOSITE_PROVIDERS=[
+            name.strip()
+            for name in os.environ.get(
+                "RATE_COMPOSITE_PROVIDERS", "binance,kraken,kucoin,coinbase"
+            ).split(",")
+            if name.strip()
+        ],
+        RATE_COMPOSITE_STRATEGY=os.environ.get("RATE_COMPOSITE_STRATEGY", "first"),
+        RATE_COMPOSITE_DEADLINE=float(os.environ.get("RATE_COMPOSITE_DEADLINE", 3)),
+        RATE_COMPOSITE_PROVIDER_INFLIGHT=int(
+            os.environ.get("RATE_COMPOSITE_PROVIDER_INFLIGHT", 2)
+        ),
+        RATE_HISTORY_INTERVAL=int(os.environ.get("RATE_HISTORY_INTERVAL", 300)),
+        RATE_HISTORY_RETENTION_DAYS=int(
+            os.environ.get("RATE_HISTORY_RETENTION_DAYS", 0)
+        ),
     )
 
     if test_config is None:
@@ -161,6 +231,10 @@ def create_app(test_config=None):
             PayoutDestination,
             Invoice,
             ExchangeRate,
+            RateHistory,
+            WebhookOutbox,
+            WalletNotification,
+            MerchantEvent,
             Setting,
             # Multi-tenant models
             Merchant,
@@ -215,6 +289,10 @@ def create_app(test_config=None):
             crypto._wallet = Wallet
             ExchangeRate.register_currency(crypto)
 
+        from .address_index import address_index
+
+        address_index.refresh()
+
         from .wallet_encryption import WalletEncryptionPersistentStatus
 
         if setting := Setting.query.get("WalletEncryptionPersistentStatus"):
@@ -0,0 +1,60 @@
+"""
+Invoice Address Index
+
+In-memory set of every address an invoice has been issued for, used to
+answer "not related to any invoice" for incoming transactions without a
+database query. On shared backends (EVM, Tron) most notifications are for
+such foreign addresses.
+
+The set is loaded at startup and kept current through ORM events on
+Invoice.addr and InvoiceAddress.addr, so addresses from mkaddr() are added
+as soon as they are assigned. Rows written by other processes are picked up
+by refresh(), which loads only rows added since the last load. Until the
+first load every address is reported as possibly known.
+
+Addresses are compared case-insensitively, like the address columns on
+MariaDB/MySQL, so the index never rejects what the database would match.
+On case-sensitive databases it lets a few more lookups through.
+"""
+
+import threading
+
+
+class AddressIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._addrs = set()
+        self._loaded = False
+        self._last_invoice_id = 0
+        self._last_invoice_address_id = 0
+
+    @staticmethod
+    def normalize(addr):
+        return addr.lower()
+
+    def __contains__(self, addr):
+        """False only if no invoice was ever issued for addr."""
+        return not self._loaded or self.normalize(addr) in self._addrs
+
+    def add(self, addr):
+        if addr:
+            self._addrs.add(self.normalize(addr))
+
+    def refresh(self):
+        """Load addresses of invoices added since the last refresh."""
+        from shkeeper.models import Invoice, InvoiceAddress
+
+        with self._lock:
+            for model, last_id in (
+                (Invoice, "_last_invoice_id"),
+                (InvoiceAddress, "_last_invoice_address_id"),
+            ):
+                for row_id, addr in model.query.with_entities(
+                    model.id, model.addr
+                ).filter(model.id > getattr(self, last_id)):
+                    self.add(addr)
+                    setattr(self, last_id, max(getattr(self, last_id), row_id))
+            self._loaded = True
+
+
+address_index = AddressIndex()
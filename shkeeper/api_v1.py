@@ -1,4 +1,6 @@
 from decimal import Decimal
+import threading
+import time
 import traceback
 from os import environ
 from concurrent.futures import ThreadPoolExecutor
@@ -13,7 +15,6 @@ from flask import stream_with_context
 from shkeeper.modules.cryptos.btc import Btc
 from flask import current_app as app
 from flask.json import JSONDecoder
-from flask_sqlalchemy import sqlalchemy
 from shkeeper import requests
 
 from shkeeper import db
@@ -25,7 +26,14 @@ from shkeeper.modules.cryptos.bitcoin_lightning import BitcoinLightning
 from shkeeper.modules.cryptos.monero import Monero
 from shkeeper.modules.rates import RateSource
 from shkeeper.models import *
-from shkeeper.callback import send_notification, send_unconfirmed_notification
+from shkeeper.callback import update_confirmations
+from shkeeper.confirmation_scheduler import confirmation_scheduler
+from shkeeper.walletnotify import (
+    process_walletnotify,
+    process_walletnotify_batch,
+    seen_transactions,
+    walletnotify_workers,
+)
 from shkeeper.utils import format_decimal
 from shkeeper.wallet_encryption import (
     wallet_encryption,
@@ -183,6 +191,85 @@ def get_crypto_quote(crypto_name):
             "traceback": traceback.format_exc(),
         }
 
+@bp.post("/quotes")
+@api_key_required
+def get_crypto_quotes():
+    """
+    Quote several crypto/fiat/amount combinations in one call.
+
+    JSON body: {"quotes": [{"crypto": "BTC", "fiat": "USD", "amount": "10.5"}, ...]}
+
+    Live rates are resolved once per request and reused across items, fee
+    settings come from the ExchangeRate snapshot. Items that can't be quoted get an error entry instead of
+    failing the whole response.
+    """
+    try:
+        req = request.get_json(force=True)
+        items = req if isinstance(req, list) else req.get("quotes", [])
+
+        rates = ExchangeRate.snapshot().rates
+        available = {}
+        live_rates = {}
+
+        def crypto_available(crypto_name):
+            if crypto_name not in available:
+                crypto = Crypto.instances.get(crypto_name)
+                available[crypto_name] = bool(
+                    crypto
+                    and crypto.wallet.enabled
+                    and not (
+                        app.config.get("DISABLE_CRYPTO_WHEN_LAGS")
+                        and crypto.getstatus() != "Synced"
+                    )
+                )
+            return available[crypto_name]
+
+        quotes = []
+        for item in items:
+            crypto_name, fiat, amount_str = (
+                item.get("crypto"),
+                item.get("fiat"),
+                item.get("amount"),
+            )
+            quote = {"crypto": crypto_name, "fiat": fiat}
+            try:
+                if not crypto_name or not fiat or not amount_str:
+                    raise Exception("'crypto', 'fiat' and 'amount' are required fields.")
+                if not crypto_available(crypto_name):
+                    raise Exception(f"{crypto_name} payment gateway is unavailable")
+                if (fiat, crypto_name) not in rates:
+                    raise Exception(
+                        f"Exchange rate src config for {fiat}-{crypto_name} is not found"
+                    )
+
+                rate = rates[(fiat, crypto_name)]
+                if (fiat, crypto_name) not in live_rates:
+                    live_rates[(fiat, crypto_name)] = rate.get_rate()
+
+                amount_fiat = Decimal(amount_str)
+                amount_crypto, exchange_rate = rate.convert(
+                    amount_fiat, rate=live_rates[(fiat, crypto_name)]
+                )
+                quote.update(
+                    status="success",
+                    amount_fiat=str(amount_fiat),
+                    amount_crypto=str(amount_crypto),
+                    exchange_rate=str(exchange_rate),
+                )
+            except Exception as e:
+                quote.update(status="error", message=str(e))
+            quotes.append(quote)
+
+        return {"status": "success", "quotes": quotes}
+
+    except Exception as e:
+        app.logger.exception("Failed to get crypto quotes")
+        return {
+            "status": "error",
+            "message": str(e),
+            "traceback": traceback.format_exc(),
+        }
+
 @bp.get("/<crypto_name>/payment-gateway")
 @login_required
 def payment_gateway_get_status(crypto_name):
@@ -299,10 +386,11 @@ def autopayout(crypto_name):
 @login_required
 def status(crypto_name):
     crypto = Crypto.instances[crypto_name]
+    balance, server_status = crypto.balance_and_status()
     return {
         "name": crypto.crypto,
-        "amount": format_decimal(crypto.balance()) if crypto.balance() else 0,
-        "server": crypto.getstatus(),
+        "amount": format_decimal(balance) if balance else 0,
+        "server": server_status,
     }
 
 
@@ -316,7 +404,8 @@ def balance(crypto_name):
     fiat = "USD"
     rate = ExchangeRate.get(fiat, crypto_name)
     current_rate = rate.get_rate()
-    crypto_amount = format_decimal(crypto.balance()) if crypto.balance() else 0
+    balance, server_status = crypto.balance_and_status()
+    crypto_amount = format_decimal(balance) if balance else 0
 
     return {
         "name": crypto.crypto,
@@ -325,7 +414,7 @@ def balance(crypto_name):
         "rate": current_rate,
         "fiat": "USD",
         "amount_fiat": format_decimal(Decimal(crypto_amount) * Decimal(current_rate)),
-        "server_status": crypto.getstatus(),
+        "server_status": server_status,
     }
 
 
@@ -400,6 +489,12 @@ def payoutnotify(crypto_name):
                             balance.pending_balance = (balance.pending_balance or Decimal(0)) - merchant_payout.amount_fiat
                             balance.total_paid_out = (balance.total_paid_out or Decimal(0)) + merchant_payout.amount_fiat
 
+                        MerchantEvent.record(
+                            MerchantEvent.PAYOUT_COMPLETED,
+                            merchant_payout.merchant_id,
+                            merchant_payout.to_json(),
+                        )
+
                         app.logger.info(
                             f"[MerchantPayout #{merchant_payout.id}] Completed via payoutnotify. TX: {tx_hash}"
                         )
@@ -419,9 +514,7 @@ def walletnotify(crypto_name, txid):
             app.logger.warning("No backend key provided")
             return {"status": "error", "message": "No backend key provided"}, 403
 
-        try:
-            crypto = Crypto.instances[crypto_name]
-        except KeyError:
+        if crypto_name not in Crypto.instances:
             return {
                 "status": "success",
                 "message": f"Ignoring notification for {crypto_name}: crypto is not available for processing",
@@ -432,48 +525,15 @@ def walletnotify(crypto_name, txid):
             app.logger.warning("Wrong backend key")
             return {"status": "error", "message": "Wrong backend key"}, 403
 
-        for addr, amount, confirmations, category in crypto.getaddrbytx(txid):
-            try:
-                if category not in ("send", "receive"):
-                    app.logger.warning(
-                        f"[{crypto.crypto}/{txid}] ignoring unknown category: {category}"
-                    )
-                    continue
-
-                if category == "send":
-                    Transaction.add_outgoing(crypto, txid)
-                    continue
-
-                if confirmations == 0:
-                    app.logger.info(
-                        f"[{crypto.crypto}/{txid}] TX has no confirmations yet (entered mempool)"
-                    )
+        if not seen_transactions.should_process(crypto_name, txid):
+            return {"status": "success", "message": "Transaction already processed"}
 
-                    if app.config.get("UNCONFIRMED_TX_NOTIFICATION"):
-                        utx = UnconfirmedTransaction.add(
-                            crypto_name, txid, addr, amount
-                        )
-                        send_unconfirmed_notification(utx)
+        if app.config.get("WALLETNOTIFY_ASYNC"):
+            entry_id = WalletNotification.enqueue(crypto_name, txid)
+            walletnotify_workers.submit(app._get_current_object(), entry_id)
+            return {"status": "queued"}, 202
 
-                    continue
-
-                tx = Transaction.add(
-                    crypto,
-                    {
-                        "txid": txid,
-                        "addr": addr,
-                        "amount": amount,
-                        "confirmations": confirmations,
-                    },
-                )
-                tx.invoice.update_with_tx(tx)
-                UnconfirmedTransaction.delete(crypto_name, txid)
-                app.logger.info(f"[{crypto.crypto}/{txid}] TX has been added to db")
-                if not tx.need_more_confirmations:
-                    send_notification(tx)
-            except sqlalchemy.exc.IntegrityError as e:
-                app.logger.warning(f"[{crypto.crypto}/{txid}] TX already exist in db")
-                db.session.rollback()
+        process_walletnotify(crypto_name, txid)
         return {"status": "success"}
     except NotRelatedToAnyInvoice:
         app.logger.warning(f"Transaction {txid} is not related to any invoice")
@@ -481,7 +541,8 @@ def walletnotify(crypto_name, txid):
             "status": "success",
             "message": "Transaction is not related to any invoice",
         }
-    except Exception as e:
+    except Exception:
+        db.session.rollback()
         app.logger.exception(
             f"Exception while processing transaction notification: {crypto_name}/{txid}"
         )
@@ -491,6 +552,100 @@ def walletnotify(crypto_name, txid):
         }, 409
 
 
+@bp.post("/walletnotify/<crypto_name>")
+def walletnotify_bulk(crypto_name):
+    """Notification of several transactions.
+
+    The body has "txids": [...] to look up on the node and/or "transactions":
+    [[txid, addr, amount, confirmations, category], ...] (or the same as
+    objects) already resolved by the backend.
+    """
+    try:
+        if "X-Shkeeper-Backend-Key" not in request.headers:
+            app.logger.warning("No backend key provided")
+            return {"status": "error", "message": "No backend key provided"}, 403
+
+        if crypto_name not in Crypto.instances:
+            return {
+                "status": "success",
+                "message": f"Ignoring notification for {crypto_name}: crypto is not available for processing",
+            }
+
+        bkey = environ.get(f"SHKEEPER_BTC_BACKEND_KEY", "shkeeper")
+        if request.headers["X-Shkeeper-Backend-Key"] != bkey:
+            app.logger.warning("Wrong backend key")
+            return {"status": "error", "message": "Wrong backend key"}, 403
+
+        req = request.get_json(force=True)
+        txids = req.get("txids", [])
+        details = {}
+        for item in req.get("transactions", []):
+            if isinstance(item, dict):
+                item = itemgetter(
+                    "txid", "addr", "amount", "confirmations", "category"
+                )(item)
+            txid, addr, amount, confirmations, category = item
+            details.setdefault(txid, []).append(
+                [addr, Decimal(str(amount)), int(confirmations), category]
+            )
+
+        if app.config.get("WALLETNOTIFY_ASYNC") and not details:
+            for txid in txids:
+                if not seen_transactions.should_process(crypto_name, txid):
+                    continue
+                entry_id = WalletNotification.enqueue(crypto_name, txid)
+                walletnotify_workers.submit(app._get_current_object(), entry_id)
+            return {"status": "queued"}, 202
+
+        return {
+            "status": "success",
+            **process_walletnotify_batch(crypto_name, txids, details),
+        }
+    except Exception:
+        db.session.rollback()
+        app.logger.exception(
+            f"Exception while processing bulk transaction notification for {crypto_name}"
+        )
+        return {
+            "status": "error",
+            "message": f"Exception while processing transaction notification: {traceback.format_exc()}.",
+        }, 409
+
+
+@bp.post("/blocknotify/<crypto_name>/<blockhash>")
+def blocknotify(crypto_name, blockhash):
+    try:
+        if "X-Shkeeper-Backend-Key" not in request.headers:
+            app.logger.warning("No backend key provided")
+            return {"status": "error", "message": "No backend key provided"}, 403
+
+        if crypto_name not in Crypto.instances:
+            return {
+                "status": "success",
+                "message": f"Ignoring notification for {crypto_name}: crypto is not available for processing",
+            }
+
+        bkey = environ.get(f"SHKEEPER_BTC_BACKEND_KEY", "shkeeper")
+        if request.headers["X-Shkeeper-Backend-Key"] != bkey:
+            app.logger.warning("Wrong backend key")
+            return {"status": "error", "message": "Wrong backend key"}, 403
+
+        if not confirmation_scheduler.block_pushed(crypto_name, blockhash):
+            return {"status": "success", "message": "Block already processed"}
+
+        app.logger.info(f"[{crypto_name}] New block {blockhash}")
+        update_confirmations(force=True, crypto_name=crypto_name)
+        return {"status": "success"}
+    except Exception:
+        app.logger.exception(
+            f"Exception while processing block notification: {crypto_name}/{blockhash}"
+        )
+        return {
+            "status": "error",
+            "message": f"Exception while processing block notification: {traceback.format_exc()}.",
+        }, 409
+
+
 @bp.get("/<crypto_name>/decrypt")
 def decrypt_key(crypto_name):
     try:
@@ -587,6 +742,7 @@ def set_exchange_rate(crypto_name):
         rate_source.rate = req["rate"]
     rate_source.fee = req["fee"]
     db.session.commit()
+    ExchangeRate.rebuild_snapshot()
     return {"status": "success"}
 
 
@@ -713,6 +869,80 @@ def list_invoices(external_id):
         }
 
 
+class LongPollSlots:
+    """Number of request threads held by long-polls, at most a limit."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._taken = 0
+
+    def acquire(self, limit):
+        with self._lock:
+            if self._taken >= limit:
+                return False
+            self._taken += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._taken -= 1
+
+
+events_long_polls = LongPollSlots()
+
+
+@bp.get("/events")
+@api_key_required
+def list_events():
+    """
+    Incremental event feed: GET /api/v1/events?after=<cursor>&limit=<n>&wait=<seconds>
+
+    Returns events with an id greater than `after`, oldest first, and the
+    cursor to pass as `after` next time. With `wait`, the request is held
+    (up to EVENTS_MAX_WAIT seconds) until at least one new event exists.
+    Every held request takes a server thread, so at most EVENTS_MAX_WAITERS
+    are held at once, others are answered right away.
+
+    Ids are assigned on insert but become visible on commit. That is the
+    same order on SQLite, which serializes writers. On a server database an
+    event whose transaction commits after one with a higher id can be
+    passed over by a client that already moved its cursor past it.
+    """
+    try:
+        merchant_id = g.merchant.id if getattr(g, "merchant", None) else None
+        cursor = request.args.get("after", 0, type=int)
+        limit = max(1, min(request.args.get("limit", 100, type=int), 1000))
+        wait = max(
+            0, min(request.args.get("wait", 0, type=float), app.config["EVENTS_MAX_WAIT"])
+        )
+
+        events = MerchantEvent.after(merchant_id, cursor, limit)
+        if (
+            not events
+            and wait
+            and events_long_polls.acquire(app.config["EVENTS_MAX_WAITERS"])
+        ):
+            try:
+                until = time.monotonic() + wait
+                while not events and (remaining := until - time.monotonic()) > 0:
+                    # end the read transaction so the next query sees new commits
+                    db.session.rollback()
+                    time.sleep(min(app.config["EVENTS_POLL_INTERVAL"], remaining))
+                    events = MerchantEvent.after(merchant_id, cursor, limit)
+            finally:
+                events_long_polls.release()
+
+        return {
+            "status": "success",
+            "events": [event.to_json() for event in events],
+            "cursor": events[-1].id if events else cursor,
+            "has_more": len(events) == limit,
+        }
+    except Exception as e:
+        app.logger.exception("Failed to list events")
+        return {"status": "error", "message": str(e)}
+
+
 @bp.get("/invoice/<int:invoice_id>/status")
 @api_key_required
 def get_invoice_status(invoice_id):
@@ -1,10 +1,11 @@
 import click
 import hmac
 import hashlib
+import threading
 import time
 from datetime import datetime, timedelta
 from decimal import Decimal
-from shkeeper import requests
+from shkeeper.http_pool import webhook_sessions
 
 from flask import Blueprint, json
 from flask import current_app as app
@@ -12,10 +13,14 @@ from flask import current_app as app
 from shkeeper.modules.classes.crypto import Crypto
 from shkeeper.models import (
     db, Invoice, InvoiceAddress, Transaction, UnconfirmedTransaction,
-    InvoiceStatus, FeeCalculationPolicy, Merchant, MerchantBalance,
-    PlatformSettings, CommissionRecord
+    InvoiceStatus, Merchant, MerchantBalance,
+    PlatformSettings, CommissionRecord, WebhookOutbox, WebhookOutboxStatus
 )
 from shkeeper.utils import format_decimal, remove_exponent
+from shkeeper.confirmation_scheduler import confirmation_scheduler
+from shkeeper.webhook_breaker import webhook_breakers
+from shkeeper.webhook_dispatcher import WebhookJob, webhook_dispatcher
+from shkeeper.webhook_timer import webhook_timer
 
 
 bp = Blueprint("callback", __name__)
@@ -92,7 +97,7 @@ def calculate_commission(merchant, amount_fiat):
 
 def record_commission(invoice, tx, commission_amount, commission_percent, commission_fixed):
     """
-    Record commission and update merchant balance.
+    Record commission and update merchant balance. The caller commits.
 
     Args:
         invoice: The Invoice object
@@ -131,12 +136,11 @@ def record_commission(invoice, tx, commission_amount, commission_percent, commis
     db.session.add(commission_record)
 
     # Update merchant balance (track per-crypto AND per-fiat)
-    balance = MerchantBalance.get_or_create(merchant.id, tx.crypto, invoice.fiat)
-    balance.total_received = (balance.total_received or Decimal(0)) + invoice.balance_fiat
-    balance.total_commission = (balance.total_commission or Decimal(0)) + commission_amount
-    balance.available_balance = (balance.available_balance or Decimal(0)) + net_amount
+    balance = MerchantBalance.get_or_create(
+        merchant.id, tx.crypto, invoice.fiat, commit=False
+    )
+    balance.credit(invoice.balance_fiat, commission_amount, net_amount)
 
-    db.session.commit()
     app.logger.info(
         f"[{tx.crypto}/{tx.txid}] Commission recorded: "
         f"gross={invoice.balance_fiat}, commission={commission_amount} ({commission_percent}%), "
@@ -144,29 +148,34 @@ def record_commission(invoice, tx, commission_amount, commission_percent, commis
     )
 
 
-def send_unconfirmed_notification(utx: UnconfirmedTransaction):
-    app.logger.info(
-        f"send_unconfirmed_notification started for {utx.crypto} {utx.txid}, {utx.addr}, {utx.amount_crypto}"
+def settle_commission(tx):
+    """
+    Record the commission once the invoice of tx is paid, in the caller's
+    transaction with the invoice locked. The caller commits.
+    """
+    invoice = tx.invoice
+    if not invoice.merchant_id or invoice.commission_amount:
+        return
+    if invoice.status not in (InvoiceStatus.PAID, InvoiceStatus.OVERPAID):
+        return
+
+    merchant = Merchant.query.get(invoice.merchant_id)
+    commission_amount, _, commission_percent, commission_fixed = calculate_commission(
+        merchant, invoice.balance_fiat
     )
+    record_commission(invoice, tx, commission_amount, commission_percent, commission_fixed)
 
+
+def unconfirmed_invoice(utx: UnconfirmedTransaction):
     invoice_address = InvoiceAddress.query.filter_by(
         crypto=utx.crypto, addr=utx.addr
     ).first()
-    invoice = Invoice.query.filter_by(id=invoice_address.invoice_id).first()
+    return Invoice.query.filter_by(id=invoice_address.invoice_id).first()
 
-    # Skip if no callback URL configured
-    if not invoice.callback_url:
-        app.logger.info(
-            f"[{utx.crypto}/{utx.txid}] No callback URL configured, marking as confirmed"
-        )
-        utx.callback_confirmed = True
-        db.session.commit()
-        return True
 
+def build_unconfirmed_notification(utx: UnconfirmedTransaction, invoice):
     crypto = Crypto.instances[utx.crypto]
-    apikey = crypto.wallet.apikey
-
-    notification = {
+    return {
         "status": "unconfirmed",
         "external_id": invoice.external_id,
         "crypto": utx.crypto,
@@ -175,64 +184,10 @@ def send_unconfirmed_notification(utx: UnconfirmedTransaction):
         "amount": format_decimal(utx.amount_crypto, precision=crypto.precision),
     }
 
-    # Build headers with backward-compatible API key + new signature for merchants
-    headers = {
-        "X-Torpay-Api-Key": apikey,
-        "X-Shkeeper-Api-Key": apikey,  # backward compatibility
-    }
-    if invoice.merchant_id:
-        merchant = Merchant.query.get(invoice.merchant_id)
-        if merchant and merchant.webhook_secret:
-            timestamp = int(time.time())
-            signature = generate_webhook_signature(notification, merchant.webhook_secret, timestamp)
-            headers["X-Shkeeper-Signature"] = signature
-            headers["X-Shkeeper-Timestamp"] = str(timestamp)
-
-    app.logger.warning(
-        f"[{utx.crypto}/{utx.txid}] Posting {notification} to {invoice.callback_url} with api key {apikey}"
-    )
-    try:
-        r = requests.post(
-            invoice.callback_url,
-            json=notification,
-            headers=headers,
-            timeout=app.config.get("REQUESTS_NOTIFICATION_TIMEOUT"),
-        )
-    except Exception as e:
-        app.logger.error(
-            f"[{utx.crypto}/{utx.txid}] Unconfirmed TX notification failed: {e}"
-        )
-        return False
-
-    if r.status_code != 202:
-        app.logger.warning(
-            f"[{utx.crypto}/{utx.txid}] Unconfirmed TX notification failed with HTTP code {r.status_code}"
-        )
-        return False
-
-    utx.callback_confirmed = True
-    db.session.commit()
-    app.logger.info(
-        f"[{utx.crypto}/{utx.txid}] Unconfirmed TX notification has been accepted"
-    )
-
-    return True
-
-
-def send_notification(tx):
-    app.logger.info(f"[{tx.crypto}/{tx.txid}] Notificator started")
 
+def build_notification(tx):
     invoice = tx.invoice
 
-    # Skip if no callback URL configured
-    if not invoice.callback_url:
-        app.logger.info(
-            f"[{tx.crypto}/{tx.txid}] No callback URL configured, marking as confirmed"
-        )
-        tx.callback_confirmed = True
-        db.session.commit()
-        return True
-
     # Calculate commission if this is a merchant invoice and payment is complete
     commission_amount = Decimal(0)
     net_amount = invoice.balance_fiat
@@ -247,6 +202,7 @@ def send_notification(tx):
         if not invoice.commission_amount or invoice.commission_amount == 0:
             record_commission(invoice, tx, commission_amount, commission_percent, commission_fixed)
 
+    rate = invoice.rate
     transactions = []
     for t in invoice.transactions:
         amount_fiat_without_fee = t.rate.get_orig_amount(t.amount_fiat)
@@ -273,13 +229,9 @@ def send_notification(tx):
         "paid": invoice.status in (InvoiceStatus.PAID, InvoiceStatus.OVERPAID),
         "status": invoice.status.name,
         "transactions": transactions,
-        "fee_percent": remove_exponent(invoice.rate.fee),
-        "fee_fixed": remove_exponent(invoice.rate.fixed_fee),
-        "fee_policy": (
-            invoice.rate.fee_policy.name
-            if invoice.rate.fee_policy
-            else FeeCalculationPolicy.PERCENT_FEE.name
-        ),
+        "fee_percent": remove_exponent(rate.fee),
+        "fee_fixed": remove_exponent(rate.fixed_fee),
+        "fee_policy": rate.fee_policy.name,
     }
 
     # Add commission info for merchant invoices
@@ -294,47 +246,360 @@ def send_notification(tx):
     notification["overpaid_fiat"] = (
         str(round(overpaid_fiat.normalize(), 2)) if overpaid_fiat > 0 else "0.00"
     )
+    return notification
+
+
+def first_attempt_at(invoice, at=None):
+    """Batch mode merchants get their events a WEBHOOK_BATCH_WINDOW later,
+    so events that follow shortly after can share the request."""
+    at = at or datetime.now()
+    if invoice.merchant_id and invoice.merchant.webhook_batch:
+        at = max(
+            at,
+            datetime.now() + timedelta(seconds=app.config.get("WEBHOOK_BATCH_WINDOW")),
+        )
+    return at
+
+
+def enqueue_unconfirmed_notification(utx: UnconfirmedTransaction):
+    """Put the notification for utx into the outbox.
+
+    Returns the outbox entry, or None if there is nothing to deliver.
+    """
+    if entry := WebhookOutbox.get("utx", utx):
+        return entry
+
+    invoice = unconfirmed_invoice(utx)
+
+    # Skip if no callback URL configured
+    if not invoice.callback_url:
+        app.logger.info(
+            f"[{utx.crypto}/{utx.txid}] No callback URL configured, marking as confirmed"
+        )
+        utx.callback_confirmed = True
+        db.session.commit()
+        return None
+
+    return WebhookOutbox.add(
+        "utx",
+        utx,
+        invoice,
+        build_unconfirmed_notification(utx, invoice),
+        priority=WebhookOutbox.PRIORITY_UNCONFIRMED,
+        next_attempt_at=first_attempt_at(invoice),
+    )
+
+
+def enqueue_notification(tx, at=None):
+    """Put the notification for tx into the outbox, due at datetime at (now by default).
+
+    Returns the outbox entry, or None if there is nothing to deliver.
+    """
+    if entry := WebhookOutbox.get("tx", tx):
+        return entry
+
+    # Skip if no callback URL configured
+    if not tx.invoice.callback_url:
+        app.logger.info(
+            f"[{tx.crypto}/{tx.txid}] No callback URL configured, marking as confirmed"
+        )
+        tx.callback_confirmed = True
+        db.session.commit()
+        return None
+
+    # commission is recorded once per invoice, keep others off it meanwhile
+    Invoice.lock(tx.invoice_id)
+
+    priority = WebhookOutbox.PRIORITY_DEFAULT
+    if app.config.get("WEBHOOK_PRIORITIZE_PAID") and tx.invoice.status in (
+        InvoiceStatus.PAID,
+        InvoiceStatus.OVERPAID,
+    ):
+        priority = WebhookOutbox.PRIORITY_PAID
+
+    return WebhookOutbox.add(
+        "tx",
+        tx,
+        tx.invoice,
+        build_notification(tx),
+        priority=priority,
+        next_attempt_at=first_attempt_at(tx.invoice, at),
+    )
+
+
+def outbox_job(entry: WebhookOutbox):
+    return WebhookJob(
+        ("outbox", entry.id), entry.callback_url, deliver_outbox, (entry.id,)
+    )
+
+
+def schedule_delivery(entry: WebhookOutbox):
+    """Deliver entry as soon as its next_attempt_at is reached."""
+    webhook_timer.schedule(
+        app._get_current_object(), outbox_job(entry), entry.next_attempt_at
+    )
+
+
+def notification_due(tx):
+    """Transactions confirmed after walletnotify are reported NOTIFICATION_TASK_DELAY after they were seen."""
+    return max(
+        datetime.now(),
+        tx.created_at + timedelta(seconds=app.config.get("NOTIFICATION_TASK_DELAY")),
+    )
 
-    apikey = Crypto.instances[tx.crypto].wallet.apikey
+
+def notify(tx, at=None):
+    """Enqueue the notification for tx and schedule its delivery."""
+    if tx.invoice.status == InvoiceStatus.OUTGOING:
+        tx.callback_confirmed = True
+        db.session.commit()
+        return
+    if entry := enqueue_notification(tx, at=at):
+        schedule_delivery(entry)
+
+
+def notify_unconfirmed(utx: UnconfirmedTransaction):
+    """Enqueue the notification for utx and schedule its delivery."""
+    if entry := enqueue_unconfirmed_notification(utx):
+        schedule_delivery(entry)
+
+
+def notification_headers(entry: WebhookOutbox, payload=None):
+    """Headers for posting payload (entry's own notification by default)."""
+    apikey = Crypto.instances[entry.crypto].wallet.apikey
 
     # Build headers with backward-compatible API key + new signature for merchants
     headers = {"X-Shkeeper-Api-Key": apikey}
-    if invoice.merchant_id:
-        merchant = Merchant.query.get(invoice.merchant_id)
+    if entry.kind == "utx" or payload is not None:
+        headers["X-Torpay-Api-Key"] = apikey
+    if entry.merchant_id:
+        merchant = Merchant.query.get(entry.merchant_id)
         if merchant and merchant.webhook_secret:
             timestamp = int(time.time())
-            signature = generate_webhook_signature(notification, merchant.webhook_secret, timestamp)
+            signature = generate_webhook_signature(
+                payload if payload is not None else entry.notification,
+                merchant.webhook_secret,
+                timestamp,
+            )
             headers["X-Shkeeper-Signature"] = signature
             headers["X-Shkeeper-Timestamp"] = str(timestamp)
+    return headers
 
-    app.logger.warning(
-        f"[{tx.crypto}/{tx.txid}] Posting {json.dumps(notification)} to {invoice.callback_url} with api key {apikey}"
+
+def breaker_allows(entries, prefix):
+    """Check the circuit breaker, postponing entries while it is open."""
+    url = entries[0].callback_url
+    if webhook_breakers.allow(url):
+        return True
+    app.logger.info(
+        f"{prefix} Circuit breaker for {url} is open, postponing notification"
     )
+    retry_in = webhook_breakers.retry_in(url) or app.config.get("WEBHOOK_RETRY_BASE")
+    for entry in entries:
+        entry.postpone(retry_in)
+        schedule_delivery(entry)
+    return False
+
+
+def post_notification(url, payload, headers, prefix):
+    """POST payload to url and update the circuit breaker.
+
+    Returns (response, None) or (None, error) when the request failed.
+    """
     try:
-        r = requests.post(
-            invoice.callback_url,
-            json=notification,
+        r = webhook_sessions.post(
+            url,
+            json=payload,
             headers=headers,
             timeout=app.config.get("REQUESTS_NOTIFICATION_TIMEOUT"),
         )
     except Exception as e:
-        app.logger.error(f"[{tx.crypto}/{tx.txid}] Notification failed: {e}")
-        return False
+        app.logger.error(f"{prefix} Notification failed: {e}")
+        webhook_breakers.record_failure(url, str(e))
+        return None, str(e)
+
+    if r.status_code >= 500:
+        webhook_breakers.record_failure(url, f"HTTP {r.status_code}")
+    else:
+        webhook_breakers.record_success(url)
 
     if r.status_code != 202:
         app.logger.warning(
-            f"[{tx.crypto}/{tx.txid}] Notification failed by {invoice.callback_url} with HTTP code {r.status_code}"
+            f"{prefix} Notification failed by {url} with HTTP code {r.status_code}"
         )
-        return False
+    return r, None
 
-    tx.callback_confirmed = True
+
+def retry_later(entry, r=None, error=None):
+    if r is not None:
+        scheduled = entry.schedule_retry(
+            status_code=r.status_code, error=error or r.text[:1000]
+        )
+    else:
+        scheduled = entry.schedule_retry(error=error)
+    if scheduled:
+        schedule_delivery(entry)
+
+
+def outbox_ref(entry: WebhookOutbox):
+    """Transaction or UnconfirmedTransaction of entry, None if it no longer exists."""
+    model = Transaction if entry.kind == "tx" else UnconfirmedTransaction
+    ref = model.query.get(entry.ref_id)
+    if ref is not None and entry.txid is not None and ref.txid != entry.txid:
+        ref = None  # the id now belongs to another unconfirmed transaction
+    if ref is None:
+        # the unconfirmed transaction got confirmed and removed in the meantime
+        app.logger.info(f"[{entry.crypto}] Outbox entry {entry.id} is obsolete")
+        entry.mark_cancelled()
+    return ref
+
+
+def acknowledge(entry, ref, status_code):
+    entry.mark_delivered(status_code)
+    # a plain UPDATE, the unconfirmed transaction may be gone by now
+    confirmed = type(ref).query.filter_by(id=entry.ref_id)
+    if entry.txid is not None:
+        confirmed = confirmed.filter_by(txid=entry.txid)
+    confirmed.update({"callback_confirmed": True}, synchronize_session=False)
     db.session.commit()
+
+
+def deliver(entry: WebhookOutbox):
+    """Make one delivery attempt for an outbox entry and record its outcome."""
+    if entry.status != WebhookOutboxStatus.PENDING:
+        return entry.status == WebhookOutboxStatus.DELIVERED
+
+    ref = outbox_ref(entry)
+    if ref is None:
+        return True
+
+    prefix = f"[{entry.crypto}/{ref.txid}]"
+    if not breaker_allows([entry], prefix):
+        return False
+
+    app.logger.warning(
+        f"{prefix} Posting {entry.payload} to {entry.callback_url} (attempt {(entry.attempts or 0) + 1})"
+    )
+    r, error = post_notification(
+        entry.callback_url, entry.notification, notification_headers(entry), prefix
+    )
+    if r is None or r.status_code != 202:
+        retry_later(entry, r, error)
+        return False
+
+    acknowledge(entry, ref, r.status_code)
     app.logger.info(
-        f"[{tx.crypto}/{tx.txid}] Notification has been accepted by {invoice.callback_url}"
+        f"{prefix} Notification has been accepted by {entry.callback_url}"
     )
     return True
 
 
+_batch_lock = threading.Lock()
+_batched = set()
+
+
+def deliver_batch(entry: WebhookOutbox):
+    """
+    Deliver entry together with the other pending entries for its
+    callback_url that are due within WEBHOOK_BATCH_WINDOW, in one POST:
+
+        {"batch": true, "notifications": [{"event_id": 1, ...}, ...]}
+
+    The merchant acknowledges events by returning HTTP 202 with
+    {"accepted": [event ids]}; a 202 without that list accepts all of them.
+    Events that were not accepted are retried with backoff.
+    """
+    apikey = Crypto.instances[entry.crypto].wallet.apikey
+    until = datetime.now() + timedelta(seconds=app.config.get("WEBHOOK_BATCH_WINDOW"))
+    with _batch_lock:
+        if entry.id in _batched:
+            return False
+        candidates = (
+            WebhookOutbox.query.filter(
+                WebhookOutbox.merchant_id == entry.merchant_id,
+                WebhookOutbox.callback_url == entry.callback_url,
+                WebhookOutbox.status == WebhookOutboxStatus.PENDING,
+                WebhookOutbox.next_attempt_at <= until,
+                WebhookOutbox.id != entry.id,
+            )
+            .order_by(WebhookOutbox.priority, WebhookOutbox.next_attempt_at)
+            .limit(app.config.get("WEBHOOK_BATCH_MAX") - 1)
+        )
+        entries = [entry] + [
+            e
+            for e in candidates
+            if e.id not in _batched
+            # one X-Shkeeper-Api-Key header per request
+            and Crypto.instances[e.crypto].wallet.apikey == apikey
+        ]
+        claimed = [e.id for e in entries]
+        _batched.update(claimed)
+
+    try:
+        refs = {e.id: outbox_ref(e) for e in entries}
+        entries = [e for e in entries if refs[e.id] is not None]
+        if not entries:
+            return True
+
+        prefix = f"[batch/{entry.callback_url}]"
+        if not breaker_allows(entries, prefix):
+            return False
+
+        payload = {
+            "batch": True,
+            "notifications": [
+                {"event_id": e.id, **e.notification} for e in entries
+            ],
+        }
+        app.logger.warning(
+            f"{prefix} Posting {len(entries)} notifications {[e.id for e in entries]}"
+        )
+        r, error = post_notification(
+            entry.callback_url,
+            payload,
+            notification_headers(entry, payload=payload),
+            prefix,
+        )
+        if r is None or r.status_code != 202:
+            for e in entries:
+                retry_later(e, r, error)
+            return False
+
+        try:
+            accepted = r.json().get("accepted")
+        except Exception:
+            accepted = None
+        if isinstance(accepted, list):
+            accepted = {str(event_id) for event_id in accepted}
+        else:
+            accepted = None
+
+        for e in entries:
+            if accepted is None or str(e.id) in accepted:
+                acknowledge(e, refs[e.id], r.status_code)
+            else:
+                retry_later(e, r, "Event was not acknowledged")
+        app.logger.info(
+            f"{prefix} {len(entries) if accepted is None else len(accepted)} of "
+            f"{len(entries)} notifications have been accepted"
+        )
+        return accepted is None or str(entry.id) in accepted
+    finally:
+        with _batch_lock:
+            _batched.difference_update(claimed)
+
+
+def deliver_outbox(entry_id):
+    entry = WebhookOutbox.query.get(entry_id)
+    if not entry or entry.status != WebhookOutboxStatus.PENDING:
+        return
+    merchant = Merchant.query.get(entry.merchant_id) if entry.merchant_id else None
+    if merchant and merchant.webhook_batch:
+        deliver_batch(entry)
+    else:
+        deliver(entry)
+
+
 def list_unconfirmed():
     for tx in Transaction.query.filter_by(callback_confirmed=False):
         print(tx)
@@ -342,50 +607,173 @@ def list_unconfirmed():
         print("No unconfirmed transactions found!")
 
 
-def send_callbacks():
-    for utx in UnconfirmedTransaction.query.filter_by(callback_confirmed=False):
+def enqueue_pending():
+    """Enqueue notifications for transactions that are not in the outbox yet.
+
+    Normally walletnotify and update_confirmations enqueue them right away,
+    this catches anything missed, e.g. during a restart.
+    """
+    for utx in UnconfirmedTransaction.query.outerjoin(
+        WebhookOutbox,
+        db.and_(
+            WebhookOutbox.kind == "utx",
+            WebhookOutbox.ref_id == UnconfirmedTransaction.id,
+            WebhookOutbox.txid == UnconfirmedTransaction.txid,
+        ),
+    ).filter(
+        UnconfirmedTransaction.callback_confirmed == False,
+        WebhookOutbox.id.is_(None),
+    ):
         try:
-            send_unconfirmed_notification(utx)
+            notify_unconfirmed(utx)
         except Exception as e:
             app.logger.exception(
                 f"Exception while sending callback for UTX {utx.crypto}/{utx.txid}"
             )
 
-    for tx in Transaction.query.filter_by(
-        callback_confirmed=False, need_more_confirmations=False
+    for tx in Transaction.query.outerjoin(
+        WebhookOutbox,
+        db.and_(
+            WebhookOutbox.kind == "tx",
+            WebhookOutbox.ref_id == Transaction.id,
+            WebhookOutbox.txid == Transaction.txid,
+        ),
+    ).filter(
+        Transaction.callback_confirmed == False,
+        Transaction.need_more_confirmations == False,
+        WebhookOutbox.id.is_(None),
     ):
         try:
-            delay_until_date = tx.created_at + timedelta(
-                seconds=app.config.get("NOTIFICATION_TASK_DELAY")
-            )
-            if datetime.now() > delay_until_date:
-                app.logger.info(
-                    f"[{tx.crypto}/{tx.txid}] created at {tx.created_at}, delayed until {delay_until_date}"
-                )
-                if tx.invoice.status == InvoiceStatus.OUTGOING:
-                    tx.callback_confirmed = True
-                    db.session.commit()
-                else:
-                    app.logger.info(f"[{tx.crypto}/{tx.txid}] Notification is pending")
-                    send_notification(tx)
-            else:
-                app.logger.info(
-                    f"[{tx.crypto}/{tx.txid}] delaying notification created at {tx.created_at} until {delay_until_date}"
-                )
+            app.logger.info(f"[{tx.crypto}/{tx.txid}] Notification is pending")
+            notify(tx, at=notification_due(tx))
         except Exception as e:
             app.logger.exception(
                 f"Exception while sending callback for TX {tx.crypto}/{tx.txid}"
             )
 
 
-def update_confirmations():
-    for tx in Transaction.query.filter_by(
-        callback_confirmed=False, need_more_confirmations=True
-    ):
+def send_callbacks():
+    """Crash-recovery sweep: deliveries are normally started by the webhook
+    timer when they become due, this dispatches due outbox rows it doesn't know."""
+    enqueue_pending()
+
+    jobs = [
+        outbox_job(entry)
+        for entry in WebhookOutbox.due(
+            app.config.get("WEBHOOK_OUTBOX_BATCH"),
+            app.config.get("WEBHOOK_MERCHANT_BATCH"),
+        )
+        if ("outbox", entry.id) not in webhook_timer
+    ]
+    if jobs:
+        started = webhook_dispatcher.dispatch(app._get_current_object(), jobs)
+        app.logger.info(f"Dispatched {started} of {len(jobs)} due notifications")
+
+
+def refresh_block_heights(crypto, txs):
+    """Learn the inclusion height of txs that don't have one yet.
+
+    Returns the chain tip (None if the crypto can't report one) and the
+    confirmations looked up by txid along the way. The tip is read after the
+    lookups so a block found in between can only make the derived height too
+    high, never report confirmations that aren't there.
+    """
+    unknown = {tx.txid for tx in txs if tx.block_height is None}
+    confirmations, tip = crypto.get_confirmations_and_tip(list(unknown))
+    if tip is not None:
+        for tx in txs:
+            if confirmations.get(tx.txid, 0) > 0:
+                tx.block_height = tip - confirmations[tx.txid] + 1
+        db.session.commit()
+    return tip, confirmations
+
+
+def update_confirmations(force=False, crypto_name=None):
+    """Poll confirmations of pending transactions, of one crypto or of all.
+
+    Cryptos are skipped until the confirmation scheduler says they are due,
+    or while another poll of them is running, unless force is set.
+    """
+    query = (
+        db.session.query(Transaction.crypto)
+        .filter_by(callback_confirmed=False, need_more_confirmations=True)
+        .distinct()
+    )
+    if crypto_name:
+        query = query.filter_by(crypto=crypto_name)
+
+    for (name,) in query.all():
+        if not force and not confirmation_scheduler.due(name):
+            continue
+        lock = confirmation_scheduler.lock(name)
+        if not lock.acquire(blocking=force):
+            continue
+        try:
+            update_crypto_confirmations(name)
+        finally:
+            lock.release()
+
+
+def update_crypto_confirmations(crypto_name):
+    txs = (
+        Transaction.query.filter_by(
+            crypto=crypto_name, callback_confirmed=False, need_more_confirmations=True
+        )
+        .populate_existing()
+        .all()
+    )
+    crypto = Crypto.instances[crypto_name]
+    refreshed = True
+    try:
+        tip, confirmations = refresh_block_heights(crypto, txs)
+    except Exception:
+        app.logger.exception(f"[{crypto_name}] Failed to get chain tip")
+        tip, confirmations, refreshed = None, {}, False
+
+    # Ask the node directly when the heights are of no use, or when a
+    # height says confirmed, in case the block was reorged out
+    recheck = {
+        tx.txid
+        for tx in txs
+        if tx.txid not in confirmations
+        and (
+            not refreshed
+            or tx.block_height is not None
+            and (
+                tip is None
+                or tip - tx.block_height + 1 >= tx.invoice.wallet.confirmations
+            )
+        )
+    }
+    try:
+        rechecked = crypto.get_confirmations_by_txids(list(recheck))
+    except Exception:
+        app.logger.exception(f"[{crypto_name}] Failed to get confirmations")
+        rechecked = {}
+    confirmation_scheduler.observe(
+        crypto_name, tip, {**confirmations, **rechecked}
+    )
+
+    for tx in txs:
         try:
             app.logger.info(f"[{tx.crypto}/{tx.txid}] Updating confirmations")
-            if not tx.is_more_confirmations_needed():
+            if tx.txid in confirmations:
+                more_needed = tx.set_confirmations(confirmations[tx.txid])
+            elif tx.txid in rechecked:
+                more_needed = tx.set_confirmations(rechecked[tx.txid])
+                if more_needed and tip is not None and tx.block_height is not None:
+                    tx.block_height = None
+                    db.session.commit()
+            elif tx.txid in recheck or tx.block_height is None:
+                app.logger.warning(
+                    f"[{tx.crypto}/{tx.txid}] Failed to get confirmations"
+                )
+                continue
+            else:
+                more_needed = True
+            if not more_needed:
                 app.logger.info(f"[{tx.crypto}/{tx.txid}] Got enough confirmations")
+                notify(tx, at=notification_due(tx))
             else:
                 app.logger.info(f"[{tx.crypto}/{tx.txid}] Not enough confirmations yet")
         except Exception as e:
@@ -394,8 +782,8 @@ def update_confirmations():
             )
 
 
-@bp.cli.command()
-def list():
+@bp.cli.command("list")
+def list_command():
     """Shows list of transaction notifications to be sent"""
     list_unconfirmed()
 
@@ -409,7 +797,7 @@ def send():
 @bp.cli.command()
 def update():
     """Update number of confirmation"""
-    update_confirmations()
+    update_confirmations(force=True)
 
 
 @bp.cli.command()
@@ -0,0 +1,140 @@
+"""
+Confirmation Scheduler
+
+Decides per crypto when pending transactions are polled for confirmations.
+
+Every crypto keeps an estimate of its block interval, learned from how fast
+its chain tip advances between polls (or, for cryptos without a tip, the
+confirmations of its pending transactions). A crypto is polled about twice
+per block, within CONFIRMATION_POLL_MIN..CONFIRMATION_POLL_MAX seconds, so
+fast chains confirm sooner and slow chains are asked less often. Until a
+block has been observed a crypto is polled every CONFIRMATION_POLL_DEFAULT
+seconds. Cryptos without pending transactions are not polled at all.
+
+Backends that push new blocks to /api/v1/blocknotify get polled right away
+and, while their pushes keep coming, only every CONFIRMATION_POLL_MAX seconds
+otherwise as a fallback.
+
+State is kept in memory, a restart starts over with the default cadence.
+"""
+
+import threading
+import time
+
+from flask import current_app as app
+
+
+EMA_WEIGHT = 0.3  # weight of the newest block interval sample
+POLLS_PER_BLOCK = 2
+PUSH_MISSED_BLOCKS = 3  # pushes are considered gone after this many blocks
+
+
+class ChainCadence:
+    def __init__(self):
+        self.block_interval = None
+        self.tip = None
+        self.confirmations = {}
+        self.progress_at = None
+        self.next_poll = 0
+        self.lock = threading.Lock()
+        self.last_block = None
+        self.pushed_at = None
+
+    def push_active(self, now):
+        # a push is expected at least every few blocks
+        expected = self.block_interval or app.config["CONFIRMATION_POLL_DEFAULT"]
+        return (
+            self.pushed_at is not None
+            and now - self.pushed_at < PUSH_MISSED_BLOCKS * expected
+        )
+
+    def poll_interval(self, now):
+        if self.push_active(now):
+            return app.config["CONFIRMATION_POLL_MAX"]
+        if self.block_interval is None:
+            return app.config["CONFIRMATION_POLL_DEFAULT"]
+        return min(
+            max(
+                self.block_interval / POLLS_PER_BLOCK,
+                app.config["CONFIRMATION_POLL_MIN"],
+            ),
+            app.config["CONFIRMATION_POLL_MAX"],
+        )
+
+
+class ConfirmationScheduler:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._chains = {}
+
+    def _get(self, crypto):
+        if crypto not in self._chains:
+            self._chains[crypto] = ChainCadence()
+        return self._chains[crypto]
+
+    def due(self, crypto):
+        with self._lock:
+            return time.monotonic() >= self._get(crypto).next_poll
+
+    def poke(self, crypto):
+        """Make crypto due for its next poll right away."""
+        with self._lock:
+            self._get(crypto).next_poll = 0
+
+    def lock(self, crypto):
+        """Lock held while crypto is being polled."""
+        with self._lock:
+            return self._get(crypto).lock
+
+    def block_pushed(self, crypto, blockhash):
+        """Record a block pushed by the backend.
+
+        Returns False if it is the block pushed last time.
+        """
+        with self._lock:
+            chain = self._get(crypto)
+            chain.pushed_at = time.monotonic()
+            if chain.last_block == blockhash:
+                return False
+            chain.last_block = blockhash
+            return True
+
+    def observe(self, crypto, tip=None, confirmations=None):
+        """Record what a poll of crypto saw and schedule its next poll.
+
+        tip is the chain tip, if the crypto has one, confirmations the
+        {txid: confirmations} of the transactions looked up.
+        """
+        now = time.monotonic()
+        with self._lock:
+            chain = self._get(crypto)
+            if tip is not None:
+                advanced = tip - chain.tip if chain.tip is not None else 0
+                chain.tip = tip
+            else:
+                advanced = max(
+                    (
+                        count - chain.confirmations[txid]
+                        for txid, count in (confirmations or {}).items()
+                        if txid in chain.confirmations
+                    ),
+                    default=0,
+                )
+                chain.confirmations = dict(confirmations or {})
+
+            if chain.progress_at is None:
+                chain.progress_at = now
+            elif advanced > 0:
+                sample = (now - chain.progress_at) / advanced
+                if chain.block_interval is None:
+                    chain.block_interval = sample
+                else:
+                    chain.block_interval += EMA_WEIGHT * (
+                        sample - chain.block_interval
+                    )
+                chain.progress_at = now
+
+            chain.next_poll = now + chain.poll_interval(now)
+
+
+confirmation_scheduler = ConfirmationScheduler()
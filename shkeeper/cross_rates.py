@@ -0,0 +1,110 @@
+"""
+Fiat Cross Rates
+
+With RATE_CROSS_FIAT enabled, crypto prices are only requested from the rate
+providers in RATE_BASE_FIAT. Every other fiat is derived through a small FX
+table fetched once per FX_REFRESH_INTERVAL, so adding fiats to FIAT_CURRENCIES
+does not multiply the outbound rate traffic.
+
+FX_MANUAL_RATES ("EUR=0.92,GBP=0.79", units of fiat per one base unit) overrides
+the fetched FX table. Manual ExchangeRate rows never reach this module.
+"""
+
+import json
+import threading
+import time
+from decimal import Decimal
+
+from flask import current_app as app
+
+from shkeeper import requests
+from shkeeper.rate_cache import rate_cache
+
+
+FX_RETRY_DELAY = 60
+
+
+class FxTable:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rates = {}
+        self._fetched_at = None
+
+    def rate(self, fiat):
+        """Units of fiat for one unit of the base fiat."""
+        base = app.config["RATE_BASE_FIAT"]
+        if fiat == base:
+            return Decimal(1)
+        if fiat in (manual := self.manual_rates()):
+            return manual[fiat]
+
+        self.refresh_if_expired()
+        if fiat not in self._rates:
+            raise Exception(f"No FX rate for {base}/{fiat}")
+        return self._rates[fiat]
+
+    def refresh_if_expired(self):
+        interval = app.config["FX_REFRESH_INTERVAL"]
+        if self._fetched_at and time.monotonic() - self._fetched_at < interval:
+            return
+
+        with self._lock:
+            if self._fetched_at and time.monotonic() - self._fetched_at < interval:
+                return
+            try:
+                self._rates = self.fetch(app.config["RATE_BASE_FIAT"])
+                self._fetched_at = time.monotonic()
+            except Exception as e:
+                if not self._rates:
+                    raise
+                # keep the previous table, FX moves slowly; try again a bit later
+                app.logger.warning(f"[FX] Failed to refresh FX rates: {e}")
+                self._fetched_at = time.monotonic() - interval + FX_RETRY_DELAY
+
+    @staticmethod
+    def fetch(base):
+        url = f"https://api.coinbase.com/v2/exchange-rates?currency={base}"
+        answer = requests.get(url)
+        if answer.status_code != requests.codes.ok:
+            raise Exception(f"Can't get FX rates for {base}: HTTP {answer.status_code}")
+        rates = json.loads(answer.text).get("data", {}).get("rates", {})
+        return {fiat: Decimal(rate) for fiat, rate in rates.items()}
+
+    @staticmethod
+    def manual_rates():
+        rates = {}
+        for item in app.config.get("FX_MANUAL_RATES", "").split(","):
+            if "=" in item:
+                fiat, rate = item.split("=", 1)
+                rates[fiat.strip().upper()] = Decimal(rate.strip())
+        return rates
+
+
+fx_table = FxTable()
+
+
+def applies(fiat):
+    return (
+        app.config.get("RATE_CROSS_FIAT")
+        and fiat != app.config.get("RATE_BASE_FIAT")
+    )
+
+
+def quote_fiat(fiat):
+    """Fiat the rate providers are actually asked about."""
+    return app.config["RATE_BASE_FIAT"] if applies(fiat) else fiat
+
+
+def get_rate(source, fiat, crypto):
+    price = rate_cache.get_rate(source, quote_fiat(fiat), crypto)
+    if applies(fiat):
+        price *= fx_table.rate(fiat)
+    return price
+
+
+def get_rates(source, fiat, cryptos):
+    rates = rate_cache.get_rates(source, quote_fiat(fiat), cryptos)
+    if applies(fiat):
+        fx = fx_table.rate(fiat)
+        rates = {crypto: price * fx for crypto, price in rates.items()}
+    return rates
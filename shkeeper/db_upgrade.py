@@ -23,6 +23,14 @@ def get_existing_columns(inspector, table_name):
         return set()
 
 
+def get_existing_indexes(inspector, table_name):
+    """Get list of existing index names for a table."""
+    try:
+        return {index['name'] for index in inspector.get_indexes(table_name)}
+    except Exception:
+        return set()
+
+
 def get_existing_tables(inspector):
     """Get list of existing table names."""
     return set(inspector.get_table_names())
@@ -35,7 +43,8 @@ def upgrade_database(db, app):
     This function:
     1. Creates any missing tables
     2. Adds any missing columns to existing tables
-    3. Handles the migration gracefully without data loss
+    3. Creates any missing indexes
+    4. Handles the migration gracefully without data loss
     """
     with app.app_context():
         inspector = inspect(db.engine)
@@ -63,6 +72,15 @@ def upgrade_database(db, app):
                 if column.name not in existing_columns:
                     add_column(db, app, table_name, column)
 
+        # Finally create indexes added to existing tables
+        inspector = inspect(db.engine)
+        for table_name, table in model_tables.items():
+            existing_indexes = get_existing_indexes(inspector, table_name)
+
+            for index in table.indexes:
+                if index.name not in existing_indexes:
+                    add_index(db, app, table_name, index)
+
 
 def add_column(db, app, table_name, column):
     """Add a missing column to a table."""
@@ -125,6 +143,19 @@ def add_column(db, app, table_name, column):
             app.logger.warning(f"Could not add column {table_name}.{column_name}: {e}")
 
 
+def add_index(db, app, table_name, index):
+    """Create a missing index on a table."""
+    try:
+        app.logger.info(f"Creating index {index.name} on {table_name}")
+        index.create(db.engine)
+        app.logger.info(f"Successfully created index {index.name}")
+    except (OperationalError, ProgrammingError) as e:
+        if "already exists" in str(e).lower():
+            app.logger.debug(f"Index {index.name} already exists")
+        else:
+            app.logger.warning(f"Could not create index {index.name}: {e}")
+
+
 def ensure_platform_settings(db, app):
     """Ensure default platform settings exist."""
     from shkeeper.models import PlatformSettings
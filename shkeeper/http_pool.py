@@ -0,0 +1,88 @@
+"""
+HTTP Session Pool
+
+Keeps one requests.Session per destination origin (scheme://host:port) so
+repeated requests to the same merchant reuse keep-alive connections instead
+of paying for a TCP and TLS handshake every time.
+
+Each session holds at most WEBHOOK_POOL_MAXSIZE connections. Sessions unused
+for WEBHOOK_POOL_IDLE_TIMEOUT seconds are closed. Sessions are shared between
+threads; cookies are never stored.
+"""
+
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from flask import current_app as app
+from requests.adapters import HTTPAdapter
+
+
+class PooledSession:
+    def __init__(self, maxsize):
+        self.session = requests.Session()
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=maxsize, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+
+class SessionPool:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+    @staticmethod
+    def origin(url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}".lower()
+
+    def request(self, method, url, timeout, **kwargs):
+        """Send a request through the session for url's origin.
+
+        timeout is required, the module level default of shkeeper.requests
+        does not apply to pooled sessions.
+        """
+        pooled = self._acquire(self.origin(url))
+        try:
+            return pooled.session.request(method, url, timeout=timeout, **kwargs)
+        finally:
+            with self._lock:
+                pooled.in_use -= 1
+                pooled.last_used = time.monotonic()
+
+    def post(self, url, timeout, **kwargs):
+        return self.request("POST", url, timeout, **kwargs)
+
+    def _acquire(self, origin):
+        with self._lock:
+            self._evict_idle()
+            pooled = self._sessions.get(origin)
+            if pooled is None:
+                pooled = self._sessions[origin] = PooledSession(
+                    app.config["WEBHOOK_POOL_MAXSIZE"]
+                )
+            pooled.in_use += 1
+            pooled.last_used = time.monotonic()
+            return pooled
+
+    def _evict_idle(self):
+        idle_timeout = app.config["WEBHOOK_POOL_IDLE_TIMEOUT"]
+        now = time.monotonic()
+        for origin, pooled in list(self._sessions.items()):
+            if not pooled.in_use and now - pooled.last_used > idle_timeout:
+                del self._sessions[origin]
+                pooled.session.close()
+
+    def close(self):
+        with self._lock:
+            for pooled in self._sessions.values():
+                pooled.session.close()
+            self._sessions.clear()
+
+
+webhook_sessions = SessionPool()
@@ -328,6 +328,7 @@ def settings():
         # Update callback URL
         callback_url = request.form.get("callback_url_base", "").strip()
         merchant.callback_url_base = callback_url if callback_url else None
+        merchant.webhook_batch = request.form.get("webhook_batch") == "on"
 
         # Update payout addresses (JSON)
         import json
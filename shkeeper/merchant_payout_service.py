@@ -13,6 +13,7 @@ from shkeeper.models import (
     MerchantPayoutStatus,
     MerchantBalance,
     Merchant,
+    MerchantEvent,
     ExchangeRate,
     Transaction,
     Wallet,
@@ -161,6 +162,9 @@ def process_payout(payout_id: int) -> tuple[bool, str]:
                 balance.pending_balance = (balance.pending_balance or Decimal(0)) - payout.amount_fiat
                 balance.total_paid_out = (balance.total_paid_out or Decimal(0)) + payout.amount_fiat
 
+            MerchantEvent.record(
+                MerchantEvent.PAYOUT_COMPLETED, payout.merchant_id, payout.to_json()
+            )
             db.session.commit()
 
             app.logger.info(
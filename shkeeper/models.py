@@ -1,20 +1,41 @@
 import base64
 import codecs
 from collections import namedtuple
+from dataclasses import dataclass
 import enum
+import itertools
 import secrets
+import threading
 from datetime import datetime, timedelta
 from decimal import Decimal
 import json
+import random
+from types import MappingProxyType
 
 import bcrypt
 from flask import current_app as app
+from flask_sqlalchemy import sqlalchemy
 
 from shkeeper import db
 from shkeeper.modules.rates import RateSource
 from shkeeper.modules.classes.crypto import Crypto
 from .utils import format_decimal, remove_exponent
+from . import cross_rates
 from .exceptions import NotRelatedToAnyInvoice
+from .address_index import address_index
+
+
+def begin_immediate():
+    """
+    Start the current transaction as a write transaction on SQLite, which has
+    no row locks, so concurrent read-modify-write cycles are serialized.
+    Does nothing on other databases or once the transaction has begun.
+    """
+    if db.engine.dialect.name != "sqlite":
+        return
+    connection = db.session.connection()
+    if not connection.connection.in_transaction:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
 
 
 # ============================================================================
@@ -59,6 +80,7 @@ class Merchant(db.Model):
     # Status & Metadata
     status = db.Column(db.Enum(MerchantStatus), default=MerchantStatus.ACTIVE)
     callback_url_base = db.Column(db.String(512))  # Optional default callback
+    webhook_batch = db.Column(db.Boolean, default=False)  # Coalesce webhooks into batch POSTs
 
     # Timestamps
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
@@ -166,15 +188,33 @@ class MerchantBalance(db.Model):
     __table_args__ = (db.UniqueConstraint("merchant_id", "crypto", "fiat"),)
 
     @classmethod
-    def get_or_create(cls, merchant_id, crypto, fiat="USD"):
+    def get_or_create(cls, merchant_id, crypto, fiat="USD", commit=True):
         """Get existing balance record or create a new one."""
         balance = cls.query.filter_by(merchant_id=merchant_id, crypto=crypto, fiat=fiat).first()
         if not balance:
             balance = cls(merchant_id=merchant_id, crypto=crypto, fiat=fiat)
             db.session.add(balance)
-            db.session.commit()
+            if commit:
+                db.session.commit()
+            else:
+                db.session.flush()
         return balance
 
+    def credit(self, received, commission, net):
+        """Add a payment to the balance with a single UPDATE, so concurrent
+        payments for the same merchant don't overwrite each other."""
+        cls = type(self)
+        cls.query.filter_by(id=self.id).update(
+            {
+                cls.total_received: db.func.coalesce(cls.total_received, 0) + received,
+                cls.total_commission: db.func.coalesce(cls.total_commission, 0)
+                + commission,
+                cls.available_balance: db.func.coalesce(cls.available_balance, 0)
+                + net,
+            },
+            synchronize_session="fetch",
+        )
+
     def to_json(self):
         """Convert balance to JSON-safe dict."""
         return {
@@ -359,7 +399,7 @@ class PayoutPolicy(enum.Enum):
 class Fiat:
     @classmethod
     def list(cls):
-        return ["USD", "EUR"]
+        return app.config.get("FIAT_CURRENCIES", ["USD", "EUR"])
 
 
 class Wallet(db.Model):
@@ -431,28 +471,18 @@ class FeeCalculationPolicy(namedtuple("FeeCalculationPolicy", "name desc"), enum
         return self.name
 
 
-class ExchangeRate(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    source = db.Column(db.String, default="dynamic")  # manual or dynamic (binance, etc)
-    crypto = db.Column(db.String)
-    fiat = db.Column(db.String)
-    rate = db.Column(
-        db.Numeric, default=0
-    )  # crypto / fiat, only used is source is manual
-    fee = db.Column(db.Numeric, default=2)  # percent
-    fixed_fee = db.Column(db.Numeric, default=0)
-    fee_policy = db.Column(
-        db.Enum(FeeCalculationPolicy), default=FeeCalculationPolicy.PERCENT_FEE
-    )
+class ExchangeRatePricing:
+    """Rate and fee calculations shared by ExchangeRate rows and their snapshot."""
 
-    __table_args__ = (db.UniqueConstraint("crypto", "fiat"),)
+    @property
+    def rate_source(self):
+        return RateSource.instances.get(self.source, RateSource.instances.get("binance"))
 
     def get_rate(self):
         if self.source == "manual":
             return self.rate
 
-        rs = RateSource.instances.get(self.source, RateSource.instances.get("binance"))
-        return rs.get_rate(self.fiat, self.crypto)
+        return cross_rates.get_rate(self.rate_source, self.fiat, self.crypto)
 
     def get_fee(self, amount: Decimal) -> Decimal:
         fcp = FeeCalculationPolicy
@@ -485,16 +515,117 @@ class ExchangeRate(db.Model):
             )
         raise Exception(f"Unexpected fee policy: {self.fee_policy}")
 
-    def convert(self, amount):
-        rate = self.get_rate()
+    def get_rate_at(self, ts):
+        """Rate that was live at ts, looked up in RateHistory.
+
+        Manual rates are always current. Otherwise falls back to the current
+        rate when no recent enough sample of the current source exists.
+        """
+        if self.source == "manual":
+            return self.rate
+
+        if interval := app.config.get("RATE_HISTORY_INTERVAL"):
+            price = RateHistory.rate_at(
+                self.fiat,
+                self.crypto,
+                ts,
+                max_age=timedelta(seconds=2 * interval),
+                source=self.source,
+            )
+            if price is not None:
+                return price
+        return self.get_rate()
+
+    def convert(self, amount, rate=None):
+        if rate is None:
+            rate = self.get_rate()
         converted = (amount + self.get_fee(amount)) / rate
         crypto = Crypto.instances[self.crypto]
         converted = round(converted, crypto.precision)
         return (converted, rate)
 
+
+@dataclass(frozen=True)
+class FrozenExchangeRate(ExchangeRatePricing):
+    """Read-only copy of an ExchangeRate row."""
+
+    source: str
+    crypto: str
+    fiat: str
+    rate: Decimal
+    fee: Decimal
+    fixed_fee: Decimal
+    fee_policy: FeeCalculationPolicy
+
+
+class ExchangeRateSnapshot:
+    """
+    Immutable view of all ExchangeRate rows keyed by (fiat, crypto).
+    A new snapshot with a higher version replaces the old one as a whole.
+    """
+
+    def __init__(self, version, rates):
+        self.version = version
+        self.rates = MappingProxyType(rates)
+
+    @classmethod
+    def build(cls, version):
+        return cls(
+            version,
+            {
+                (row.fiat, row.crypto): FrozenExchangeRate(
+                    source=row.source,
+                    crypto=row.crypto,
+                    fiat=row.fiat,
+                    rate=row.rate,
+                    fee=row.fee if row.fee is not None else Decimal(0),
+                    fixed_fee=row.fixed_fee if row.fixed_fee is not None else Decimal(0),
+                    fee_policy=row.fee_policy or FeeCalculationPolicy.PERCENT_FEE,
+                )
+                for row in ExchangeRate.query.all()
+            },
+        )
+
+
+class ExchangeRate(ExchangeRatePricing, db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.String, default="dynamic")  # manual or dynamic (binance, etc)
+    crypto = db.Column(db.String)
+    fiat = db.Column(db.String)
+    rate = db.Column(
+        db.Numeric, default=0
+    )  # crypto / fiat, only used is source is manual
+    fee = db.Column(db.Numeric, default=2)  # percent
+    fixed_fee = db.Column(db.Numeric, default=0)
+    fee_policy = db.Column(
+        db.Enum(FeeCalculationPolicy), default=FeeCalculationPolicy.PERCENT_FEE
+    )
+
+    __table_args__ = (db.UniqueConstraint("crypto", "fiat"),)
+
+    _snapshot = None
+    _snapshot_lock = threading.Lock()
+
+    @classmethod
+    def snapshot(cls) -> ExchangeRateSnapshot:
+        if cls._snapshot is None:
+            cls.rebuild_snapshot()
+        return cls._snapshot
+
     @classmethod
-    def get(cls, fiat, crypto):
-        src = cls.query.filter_by(fiat=fiat, crypto=crypto).first()
+    def rebuild_snapshot(cls):
+        """Reload the snapshot, call after committing changes to ExchangeRate rows."""
+        with cls._snapshot_lock:
+            version = cls._snapshot.version + 1 if cls._snapshot else 1
+            cls._snapshot = ExchangeRateSnapshot.build(version)
+
+    @classmethod
+    def get(cls, fiat, crypto) -> FrozenExchangeRate:
+        src = cls.snapshot().rates.get((fiat, crypto))
+        if not src and cls.query.filter_by(fiat=fiat, crypto=crypto).first():
+            # the row was added after the snapshot was taken
+            cls.rebuild_snapshot()
+            src = cls.snapshot().rates.get((fiat, crypto))
         if not src:
             raise Exception(
                 f"Exchange rate src config for {fiat}-{crypto} is not found"
@@ -507,6 +638,59 @@ class ExchangeRate(db.Model):
             if not cls.query.filter_by(fiat=fiat, crypto=crypto.crypto).first():
                 db.session.add(cls(fiat=fiat, crypto=crypto.crypto))
                 db.session.commit()
+        if cls._snapshot is not None:
+            cls.rebuild_snapshot()
+
+
+class RateHistory(db.Model):
+    """
+    Exchange rate samples recorded by the rate_history task.
+    Answers "which rate was live at time T" without asking a rate provider.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    crypto = db.Column(db.String, nullable=False)
+    fiat = db.Column(db.String, nullable=False)
+    source = db.Column(db.String, nullable=False)
+    ts = db.Column(db.DateTime, nullable=False, default=db.func.current_timestamp())
+    price = db.Column(db.Numeric, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_rate_history_crypto_fiat_ts", "crypto", "fiat", "ts"),
+    )
+
+    @classmethod
+    def rate_at(cls, fiat, crypto, ts, max_age=None, source=None):
+        """Price of the last sample taken at or before ts, None if there is none."""
+        query = cls.query.filter(cls.crypto == crypto, cls.fiat == fiat, cls.ts <= ts)
+        if source is not None:
+            query = query.filter(cls.source == source)
+        if max_age is not None:
+            query = query.filter(cls.ts >= ts - max_age)
+        sample = query.order_by(cls.ts.desc()).first()
+        return sample.price if sample else None
+
+    @classmethod
+    def sample(cls):
+        """Record the current rate of every enabled crypto/fiat pair."""
+        for rate in ExchangeRate.query.all():
+            if rate.crypto not in Crypto.instances:
+                continue
+            try:
+                price = rate.get_rate()
+            except Exception as e:
+                app.logger.warning(
+                    f"[RateHistory] No {rate.crypto}/{rate.fiat} rate to record: {e}"
+                )
+                continue
+            db.session.add(
+                cls(crypto=rate.crypto, fiat=rate.fiat, source=rate.source, price=price)
+            )
+        db.session.commit()
+
+    @classmethod
+    def purge(cls, older_than):
+        db.session.execute(db.delete(cls).where(cls.ts < older_than))
+        db.session.commit()
 
 
 class InvoiceStatus(enum.Enum):
@@ -527,7 +711,7 @@ class Invoice(db.Model):
     )
     addresses = db.relationship("InvoiceAddress", backref="invoice", lazy=True)
     crypto = db.Column(db.String)
-    addr = db.Column(db.String)
+    addr = db.Column(db.String, index=True)
     external_id = db.Column(db.String)
     fiat = db.Column(db.String)
     callback_url = db.Column(db.String)
@@ -578,27 +762,92 @@ class Invoice(db.Model):
     def rate(self):
         return ExchangeRate.get(self.fiat, self.crypto)
 
-    def update_with_tx(self, tx):
+    @classmethod
+    def lock(cls, invoice_id):
+        """
+        Load the invoice locked until the current transaction ends, with
+        SELECT ... FOR UPDATE (BEGIN IMMEDIATE on SQLite).
+        """
+        begin_immediate()
+        return (
+            cls.query.filter_by(id=invoice_id)
+            .with_for_update()
+            .populate_existing()
+            .one()
+        )
+
+    @classmethod
+    def by_addresses(cls, addrs):
+        """Invoices paid to addrs as {addr: invoice}, looked up the way
+        Transaction.add does it but for all addresses in two queries."""
+        addrs = {addr for addr in addrs if addr in address_index}
+        invoice_ids = {
+            ia.addr: ia.invoice_id
+            for ia in InvoiceAddress.query.filter(InvoiceAddress.addr.in_(addrs))
+        }
+        invoices = {
+            invoice.id: invoice
+            for invoice in cls.query.filter(cls.id.in_(set(invoice_ids.values())))
+        }
+        found = {}
+        for addr, invoice_id in invoice_ids.items():
+            cls._match_address(found, addrs, addr, invoices[invoice_id])
+
+        # older instances don't have InvoiceAddress rows for every invoice
+        missing = addrs - found.keys()
+        if missing:
+            for invoice in cls.query.filter(
+                cls.addr.in_(missing), cls.status != InvoiceStatus.OUTGOING
+            ):
+                cls._match_address(found, missing, invoice.addr, invoice)
+        return found
+
+    @staticmethod
+    def _match_address(found, addrs, addr, invoice):
+        """Map the requested addrs that the database matched with the stored
+        addr to invoice. The address columns are case-insensitive on
+        MariaDB/MySQL, so a row may have matched another spelling."""
+        if addr in addrs:
+            found.setdefault(addr, invoice)
+            return
+        for requested in addrs:
+            if address_index.normalize(requested) == address_index.normalize(addr):
+                found.setdefault(requested, invoice)
+
+    def recalc_due(self):
+        """True if amount_crypto is recalculated with the current rate on payment."""
+        return (
+            self.wallet.recalc > 0
+            and self.created_at + timedelta(hours=self.wallet.recalc) < datetime.now()
+        )
+
+    def update_with_tx(self, tx, commit=True, rate=None):
+        """Add tx to the balance. rate is the exchange rate to recalculate
+        amount_crypto with, looked up if needed and not given."""
         # recalculate amount_crypto according to current exchange rate if enabled
-        if tx.invoice.wallet.recalc > 0:
-            if (
-                tx.invoice.created_at + timedelta(hours=tx.invoice.wallet.recalc)
-            ) < datetime.now():
-                (
-                    tx.invoice.amount_crypto,
-                    tx.invoice.exchange_rate,
-                ) = tx.invoice.rate.convert(tx.invoice.amount_fiat)
-                # recalculate tx fiat amount according to a new exchange rate
-                tx.amount_fiat = tx.amount_crypto * tx.invoice.exchange_rate
-
-        # add tx to invoice balance
-        tx.invoice.balance_fiat += tx.amount_fiat
+        if tx.invoice.recalc_due():
+            if rate is None:
+                rate = tx.invoice.rate.get_rate_at(tx.created_at or datetime.now())
+            (
+                tx.invoice.amount_crypto,
+                tx.invoice.exchange_rate,
+            ) = tx.invoice.rate.convert(tx.invoice.amount_fiat, rate=rate)
+            # recalculate tx fiat amount according to a new exchange rate
+            tx.amount_fiat = tx.amount_crypto * tx.invoice.exchange_rate
+
+        # add tx to invoice balance, in SQL so concurrent payments add up
+        balance = {Invoice.balance_fiat: Invoice.balance_fiat + tx.amount_fiat}
         if (
             tx.crypto == tx.invoice.crypto
         ):  # do not add different tokens e.g. TRX and TRC20 USDT
-            tx.invoice.balance_crypto += tx.amount_crypto
+            balance[Invoice.balance_crypto] = Invoice.balance_crypto + tx.amount_crypto
+        Invoice.query.filter_by(id=tx.invoice.id).update(
+            balance, synchronize_session=False
+        )
+        db.session.refresh(tx.invoice, ["balance_fiat", "balance_crypto"])
 
         # change invoice status according to its new balance
+        was_paid = tx.invoice.status in (InvoiceStatus.PAID, InvoiceStatus.OVERPAID)
         if tx.invoice.balance_fiat < (
             tx.invoice.amount_fiat * (tx.invoice.wallet.llimit / 100)
         ):
@@ -610,7 +859,14 @@ class Invoice(db.Model):
         else:
             tx.invoice.status = InvoiceStatus.OVERPAID
 
-        db.session.commit()
+        if not was_paid and tx.invoice.status in (
+            InvoiceStatus.PAID,
+            InvoiceStatus.OVERPAID,
+        ):
+            MerchantEvent.record_invoice(MerchantEvent.INVOICE_PAID, tx.invoice)
+
+        if commit:
+            db.session.commit()
         return self
 
     @classmethod
@@ -685,6 +941,8 @@ class Invoice(db.Model):
             )
             invoice.addr = crypto.mkaddr(details={"value": invoice.amount_crypto})
             db.session.add(invoice)
+            db.session.flush()
+            MerchantEvent.record_invoice(MerchantEvent.INVOICE_CREATED, invoice)
             db.session.commit()
 
             invoice_address = InvoiceAddress()
@@ -756,7 +1014,11 @@ class UnconfirmedTransaction(db.Model):
     callback_confirmed = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
 
-    __table_args__ = (db.UniqueConstraint("crypto", "txid", "invoice_id"),)
+    __table_args__ = (
+        db.UniqueConstraint("crypto", "txid", "invoice_id"),
+        # ids of removed rows must not be handed out again, see WebhookOutbox
+        {"sqlite_autoincrement": True},
+    )
 
     def to_json(self):
         return {
@@ -768,19 +1030,23 @@ class UnconfirmedTransaction(db.Model):
         }
 
     @classmethod
-    def add(cls, crypto_name, txid, addr, amount):
+    def add(cls, crypto_name, txid, addr, amount, invoice=None, commit=True):
         app.logger.info(
             f"Add unconfirmed transaction {txid} for {amount} {crypto_name} -> {addr}"
         )
 
-        invoice_address = InvoiceAddress.query.filter_by(
-            crypto=crypto_name, addr=addr
-        ).first()
-        if not invoice_address:
-            # Check address in Invoice table in case the instance was upgraded from older version that does not have InvoiceAddress table
-            invoice = Invoice.query.filter_by(addr=addr).first()
-        else:
-            invoice = Invoice.query.filter_by(id=invoice_address.invoice_id).first()
+        if addr not in address_index:
+            raise NotRelatedToAnyInvoice(f"{addr} is not related to any invoice")
+
+        if not invoice:
+            invoice_address = InvoiceAddress.query.filter_by(
+                crypto=crypto_name, addr=addr
+            ).first()
+            if not invoice_address:
+                # Check address in Invoice table in case the instance was upgraded from older version that does not have InvoiceAddress table
+                invoice = Invoice.query.filter_by(addr=addr).first()
+            else:
+                invoice = Invoice.query.filter_by(id=invoice_address.invoice_id).first()
 
         if not invoice:
             raise NotRelatedToAnyInvoice(f"{addr} is not related to any invoice")
@@ -793,17 +1059,27 @@ class UnconfirmedTransaction(db.Model):
             addr=addr,
         )
         db.session.add(t)
-        db.session.commit()
+        MerchantEvent.record_tx(MerchantEvent.TX_UNCONFIRMED, t, invoice)
+        if commit:
+            db.session.commit()
         return t
 
     @classmethod
-    def delete(cls, crypto_name, txid):
+    def delete(cls, crypto_name, txid, commit=True):
         app.logger.info(f"Delete unconfirmed transaction {crypto_name} {txid}")
 
+        # nothing left to report as unconfirmed, delivered entries stay as they are
+        WebhookOutbox.query.filter_by(
+            kind="utx", crypto=crypto_name, txid=txid, status=WebhookOutboxStatus.PENDING
+        ).update(
+            {WebhookOutbox.status: WebhookOutboxStatus.CANCELLED},
+            synchronize_session=False,
+        )
         db.session.execute(
             db.delete(UnconfirmedTransaction).filter_by(crypto=crypto_name, txid=txid)
         )
-        db.session.commit()
+        if commit:
+            db.session.commit()
 
 
 class Transaction(db.Model):
@@ -815,6 +1091,7 @@ class Transaction(db.Model):
     amount_fiat = db.Column(db.Numeric)
     need_more_confirmations = db.Column(db.Boolean, default=True)
     callback_confirmed = db.Column(db.Boolean, default=False)
+    block_height = db.Column(db.Integer)  # height of the including block, once known
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     updated_at = db.Column(
         db.DateTime,
@@ -849,8 +1126,10 @@ class Transaction(db.Model):
             return self.invoice.addr
 
     @classmethod
-    def add_outgoing(cls, crypto, txid):
-        for addr, amount, _, _ in crypto.getaddrbytx(txid):
+    def add_outgoing(cls, crypto, txid, details=None, commit=True, rate=None):
+        """Record a payout, details are getaddrbytx(txid) if already known
+        and rate the USD rate of crypto if already known."""
+        for addr, amount, _, _ in details or crypto.getaddrbytx(txid):
             existed_tx = Transaction.query.filter_by(txid=txid).first()
 
             if not existed_tx:
@@ -859,36 +1138,46 @@ class Transaction(db.Model):
                     addr=addr, fiat="USD", status=InvoiceStatus.OUTGOING
                 )
                 db.session.add(payout_invoice)
-                db.session.commit()
+                db.session.flush()
     
                 tx = cls()
                 tx.invoice_id = payout_invoice.id
                 tx.txid = txid
                 tx.crypto = crypto.crypto
                 tx.amount_crypto = amount
-                rate = ExchangeRate.get(payout_invoice.fiat, tx.crypto).get_rate()
+                if rate is None:
+                    rate = ExchangeRate.get(
+                        payout_invoice.fiat, tx.crypto
+                    ).get_rate_at(datetime.now())
                 tx.amount_fiat = tx.amount_crypto * rate
                 tx.need_more_confirmations = False
                 tx.callback_confirmed = True
     
                 db.session.add(tx)
-                db.session.commit()
+                if commit:
+                    db.session.commit()
             
             else:
                 pass
                 # Already in DB, skip
 
     @classmethod
-    def add(cls, crypto, tx):
-        invoice_address = InvoiceAddress.query.filter_by(addr=tx["addr"]).first()
+    def add(cls, crypto, tx, invoice=None, commit=True, rate=None):
+        """Store a payment of invoice. rate is the fiat rate of crypto, used
+        if it is not the invoice crypto and looked up if not given."""
+        if tx["addr"] not in address_index:
+            raise NotRelatedToAnyInvoice(f"{tx['addr']} is not related to any invoice")
 
-        if not invoice_address:
-            # Check address in Invoice table in case the instance was upgraded from older version that does not have InvoiceAddress table
-            invoice = Invoice.query.filter(
-                Invoice.addr == tx["addr"], Invoice.status != InvoiceStatus.OUTGOING
-            ).first()
-        else:
-            invoice = Invoice.query.filter_by(id=invoice_address.invoice_id).first()
+        if not invoice:
+            invoice_address = InvoiceAddress.query.filter_by(addr=tx["addr"]).first()
+
+            if not invoice_address:
+                # Check address in Invoice table in case the instance was upgraded from older version that does not have InvoiceAddress table
+                invoice = Invoice.query.filter(
+                    Invoice.addr == tx["addr"], Invoice.status != InvoiceStatus.OUTGOING
+                ).first()
+            else:
+                invoice = Invoice.query.filter_by(id=invoice_address.invoice_id).first()
 
         if not invoice:
             raise NotRelatedToAnyInvoice(f"{tx['addr']} is not related to any invoice")
@@ -899,27 +1188,340 @@ class Transaction(db.Model):
         t.crypto = crypto.crypto
         t.amount_crypto = tx["amount"]
         if invoice.crypto != crypto.crypto:
-            rate = ExchangeRate.get(invoice.fiat, crypto.crypto).get_rate()
+            if rate is None:
+                rate = ExchangeRate.get(invoice.fiat, crypto.crypto).get_rate_at(
+                    datetime.now()
+                )
             t.amount_fiat = t.amount_crypto * rate
         else:
             t.amount_fiat = t.amount_crypto * invoice.exchange_rate
 
         if tx["confirmations"] >= crypto.wallet.confirmations:
             t.need_more_confirmations = False
+            MerchantEvent.record_tx(MerchantEvent.TX_CONFIRMED, t, invoice)
 
         db.session.add(t)
-        db.session.commit()
+        if commit:
+            db.session.commit()
         return t
 
     def is_more_confirmations_needed(self):
         crypto = Crypto.instances[self.crypto]
-        confirmations = crypto.get_confirmations_by_txid(self.txid)
+        return self.set_confirmations(crypto.get_confirmations_by_txid(self.txid))
+
+    def set_confirmations(self, confirmations):
         if confirmations >= self.invoice.wallet.confirmations:
             self.need_more_confirmations = False
+            MerchantEvent.record_tx(MerchantEvent.TX_CONFIRMED, self, self.invoice)
             db.session.commit()
         return self.need_more_confirmations
 
 
+class MerchantEvent(db.Model):
+    """
+    Append-only log of invoice, transaction and payout events, read by
+    GET /api/v1/events. The id is the pagination cursor.
+
+    Events are added with record() in the same database transaction as the
+    state change they describe, the caller commits.
+    """
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    merchant_id = db.Column(db.Integer, db.ForeignKey("merchant.id"), nullable=True)
+    type = db.Column(db.String, nullable=False)
+    invoice_id = db.Column(db.Integer, nullable=True)
+    payload = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    __table_args__ = (db.Index("ix_merchant_event_merchant_id_id", "merchant_id", "id"),)
+
+    INVOICE_CREATED = "invoice.created"
+    INVOICE_PAID = "invoice.paid"
+    TX_UNCONFIRMED = "tx.unconfirmed"
+    TX_CONFIRMED = "tx.confirmed"
+    PAYOUT_COMPLETED = "payout.completed"
+
+    @classmethod
+    def record(cls, type, merchant_id, payload, invoice_id=None):
+        db.session.add(
+            cls(
+                type=type,
+                merchant_id=merchant_id,
+                invoice_id=invoice_id,
+                payload=json.dumps(payload),
+            )
+        )
+
+    @classmethod
+    def record_invoice(cls, type, invoice):
+        cls.record(
+            type,
+            invoice.merchant_id,
+            {
+                "external_id": invoice.external_id,
+                "crypto": invoice.crypto,
+                "addr": invoice.addr,
+                "fiat": invoice.fiat,
+                "amount_fiat": remove_exponent(invoice.amount_fiat),
+                "amount_crypto": remove_exponent(invoice.amount_crypto),
+                "balance_fiat": remove_exponent(invoice.balance_fiat),
+                "status": (invoice.status or InvoiceStatus.UNPAID).name,
+            },
+            invoice_id=invoice.id,
+        )
+
+    @classmethod
+    def record_tx(cls, type, tx, invoice):
+        cls.record(
+            type,
+            invoice.merchant_id,
+            {**tx.to_json(), "external_id": invoice.external_id},
+            invoice_id=invoice.id,
+        )
+
+    @classmethod
+    def after(cls, merchant_id, cursor, limit):
+        """Events with an id greater than cursor, oldest first.
+
+        merchant_id None returns the events of all merchants (legacy API key).
+        """
+        query = cls.query.filter(cls.id > cursor)
+        if merchant_id is not None:
+            query = query.filter(cls.merchant_id == merchant_id)
+        return query.order_by(cls.id).limit(limit).all()
+
+    def to_json(self):
+        return {
+            "id": self.id,
+            "type": self.type,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "data": json.loads(self.payload),
+        }
+
+
+class WebhookOutboxStatus(enum.Enum):
+    PENDING = "pending"
+    DELIVERED = "delivered"
+    CANCELLED = "cancelled"
+
+
+class WebhookOutbox(db.Model):
+    """
+    Notification waiting to be delivered to a merchant callback_url.
+
+    The payload is serialized when the notification is enqueued; every
+    delivery attempt is recorded on the row and failed ones are retried with
+    exponential backoff (WEBHOOK_RETRY_BASE doubling up to WEBHOOK_RETRY_MAX).
+
+    Entries are identified by kind, ref_id and txid: unconfirmed_transaction
+    rows of older SQLite databases hand out the ids of removed rows again.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String, nullable=False)  # tx or utx
+    ref_id = db.Column(db.Integer, nullable=False)  # Transaction / UnconfirmedTransaction id
+    txid = db.Column(db.String)
+    crypto = db.Column(db.String)
+    invoice_id = db.Column(db.Integer, db.ForeignKey("invoice.id"), nullable=False)
+    merchant_id = db.Column(db.Integer, db.ForeignKey("merchant.id"), nullable=True)
+    callback_url = db.Column(db.String, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    priority = db.Column(db.Integer, default=1)  # lower is delivered first
+    status = db.Column(
+        db.Enum(WebhookOutboxStatus), default=WebhookOutboxStatus.PENDING
+    )
+    attempts = db.Column(db.Integer, default=0)
+    last_status_code = db.Column(db.Integer)
+    last_error = db.Column(db.Text)
+    next_attempt_at = db.Column(
+        db.DateTime, default=db.func.current_timestamp(), index=True
+    )
+    delivered_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    __table_args__ = (db.UniqueConstraint("kind", "ref_id", "txid"),)
+
+    @property
+    def notification(self):
+        return json.loads(self.payload)
+
+    @classmethod
+    def get(cls, kind, ref):
+        return cls.query.filter_by(kind=kind, ref_id=ref.id, txid=ref.txid).first()
+
+    PRIORITY_PAID = 0
+    PRIORITY_DEFAULT = 1
+    PRIORITY_UNCONFIRMED = 2
+
+    @classmethod
+    def add(
+        cls,
+        kind,
+        ref,
+        invoice,
+        notification,
+        priority=PRIORITY_DEFAULT,
+        next_attempt_at=None,
+    ):
+        entry = cls(
+            kind=kind,
+            ref_id=ref.id,
+            txid=ref.txid,
+            crypto=ref.crypto,
+            invoice_id=invoice.id,
+            merchant_id=invoice.merchant_id,
+            callback_url=invoice.callback_url,
+            payload=json.dumps(notification),
+            priority=priority,
+            next_attempt_at=next_attempt_at or datetime.now(),
+        )
+        db.session.add(entry)
+        db.session.commit()
+        return entry
+
+    @classmethod
+    def due(cls, limit, per_merchant):
+        """
+        Due entries for one dispatch cycle, shared fairly between merchants.
+
+        Every merchant (legacy invoices without a merchant count as one)
+        contributes at most per_merchant entries, ordered by priority and due
+        time. The result interleaves merchants round-robin, so a merchant with
+        thousands of pending notifications gets one slot per round like
+        everybody else.
+        """
+        due = cls.query.filter(
+            cls.status == WebhookOutboxStatus.PENDING,
+            cls.next_attempt_at <= datetime.now(),
+        )
+        queues = []
+        for (merchant_id,) in due.with_entities(cls.merchant_id).distinct():
+            queues.append(
+                due.filter(
+                    cls.merchant_id == merchant_id
+                    if merchant_id is not None
+                    else cls.merchant_id.is_(None)
+                )
+                .order_by(cls.priority, cls.next_attempt_at)
+                .limit(per_merchant)
+                .all()
+            )
+
+        entries = []
+        for round_ in itertools.zip_longest(*queues):
+            entries.extend(
+                sorted((e for e in round_ if e), key=lambda e: e.priority)
+            )
+        return entries[:limit]
+
+    def mark_delivered(self, status_code):
+        self.attempts = (self.attempts or 0) + 1
+        self.last_status_code = status_code
+        self.last_error = None
+        self.status = WebhookOutboxStatus.DELIVERED
+        self.delivered_at = datetime.now()
+        db.session.commit()
+
+    def mark_cancelled(self):
+        self.status = WebhookOutboxStatus.CANCELLED
+        db.session.commit()
+
+    def postpone(self, seconds):
+        """Move the next attempt without counting one."""
+        self.next_attempt_at = datetime.now() + timedelta(seconds=seconds)
+        db.session.commit()
+
+    def schedule_retry(self, status_code=None, error=None):
+        """Record a failed attempt, False if the entry is no longer pending."""
+        # it may have been cancelled while the attempt was in flight
+        db.session.refresh(self, ["status"])
+        if self.status != WebhookOutboxStatus.PENDING:
+            db.session.commit()
+            return False
+        self.attempts = (self.attempts or 0) + 1
+        self.last_status_code = status_code
+        self.last_error = error
+        delay = min(
+            app.config["WEBHOOK_RETRY_BASE"] * 2 ** (self.attempts - 1),
+            app.config["WEBHOOK_RETRY_MAX"],
+        )
+        # jitter keeps retries against one endpoint from arriving in bursts
+        delay *= random.uniform(0.8, 1.2)
+        self.next_attempt_at = datetime.now() + timedelta(seconds=delay)
+        db.session.commit()
+        return True
+
+
+class WalletNotification(db.Model):
+    """
+    Transaction notification from a crypto backend waiting to be processed
+    by the walletnotify workers (WALLETNOTIFY_ASYNC mode).
+
+    A (crypto, txid) pair is queued at most once. Notifications arriving
+    while it is queued bump the received counter, so one that comes in while
+    a worker is busy with the pair gets processed again afterwards. The row
+    is removed once processed; failures are retried with exponential backoff
+    (WALLETNOTIFY_RETRY_BASE doubling up to WALLETNOTIFY_RETRY_MAX).
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    crypto = db.Column(db.String, nullable=False)
+    txid = db.Column(db.String, nullable=False)
+    received = db.Column(db.Integer, default=1)
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text)
+    next_attempt_at = db.Column(
+        db.DateTime, default=db.func.current_timestamp(), index=True
+    )
+    created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    __table_args__ = (db.UniqueConstraint("crypto", "txid"),)
+
+    @classmethod
+    def enqueue(cls, crypto, txid):
+        """Queue a notification, returns the id of its queue entry."""
+        for _ in range(2):
+            bumped = cls.query.filter_by(crypto=crypto, txid=txid).update(
+                {"received": cls.received + 1, "next_attempt_at": datetime.now()}
+            )
+            if not bumped:
+                db.session.add(
+                    cls(crypto=crypto, txid=txid, next_attempt_at=datetime.now())
+                )
+            try:
+                db.session.commit()
+                break
+            except sqlalchemy.exc.IntegrityError:
+                # queued by a concurrent request in the meantime
+                db.session.rollback()
+        return cls.query.filter_by(crypto=crypto, txid=txid).first().id
+
+    @classmethod
+    def due(cls, limit):
+        return (
+            cls.query.filter(cls.next_attempt_at <= datetime.now())
+            .order_by(cls.next_attempt_at)
+            .limit(limit)
+            .all()
+        )
+
+    def finish(self, received):
+        """Remove the entry unless it was notified again since received was read.
+
+        Returns True if the entry was removed.
+        """
+        removed = self.query.filter_by(id=self.id, received=received).delete()
+        db.session.commit()
+        return bool(removed)
+
+    def schedule_retry(self, error):
+        self.attempts = (self.attempts or 0) + 1
+        self.last_error = error
+        delay = min(
+            app.config["WALLETNOTIFY_RETRY_BASE"] * 2 ** (self.attempts - 1),
+            app.config["WALLETNOTIFY_RETRY_MAX"],
+        )
+        self.next_attempt_at = datetime.now() + timedelta(seconds=delay)
+        db.session.commit()
+
+
 class PayoutStatus(enum.Enum):
     IN_PROGRESS = enum.auto()
     SUCCESS = enum.auto()
@@ -985,11 +1587,17 @@ class InvoiceAddress(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     invoice_id = db.Column(db.Integer, db.ForeignKey("invoice.id"), nullable=False)
     crypto = db.Column(db.String)
-    addr = db.Column(db.String)
+    addr = db.Column(db.String, index=True)
     created_at = db.Column(db.DateTime, default=db.func.current_timestamp())
     __table_args__ = (db.UniqueConstraint("invoice_id", "crypto", "addr"),)
 
 
+@db.event.listens_for(Invoice.addr, "set")
+@db.event.listens_for(InvoiceAddress.addr, "set")
+def index_invoice_address(target, value, oldvalue, initiator):
+    address_index.add(value)
+
+
 class BitcoinLightningInvoice(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     r_hash = db.Column(db.String, unique=True, nullable=False)
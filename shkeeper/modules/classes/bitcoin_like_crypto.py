@@ -30,16 +30,31 @@ class BitcoinLikeCrypto(Crypto):
                 json=self.build_rpc_request("getblockchaininfo"),
                 timeout=10,
             ).json(parse_float=Decimal)
+            return self.sync_status(response)
+        except Exception:
+            return "Offline"
+
+    def sync_status(self, response):
+        if response["result"]["headers"] == response["result"]["blocks"]:
+            return "Synced"
+        else:
+            return "Sync In Progress (%.2f%%)" % (
+                response["result"]["verificationprogress"] * 100
+            )
 
-            if response["result"]["headers"] == response["result"]["blocks"]:
-                return "Synced"
-            else:
-                return "Sync In Progress (%.2f%%)" % (
-                    response["result"]["verificationprogress"] * 100
-                )
+    def balance_and_status(self):
+        try:
+            balance, info = self.rpc_batch(
+                [("getbalance", ("*", 1)), ("getblockchaininfo", ())], timeout=10
+            )
+        except Exception:
+            return False, "Offline"
 
+        try:
+            status = self.sync_status(info)
         except Exception as e:
-            return "Offline"
+            status = "Offline"
+        return balance["result"], status
 
     def mkpayout(self, destination, amount, fee, subtract_fee_from_amount=False):
         btc_per_kb = "%.8f" % (float(fee) / 100000)
@@ -82,7 +97,19 @@ class BitcoinLikeCrypto(Crypto):
             auth=self.get_rpc_credentials(),
             json=self.build_rpc_request("gettransaction", txid),
         ).json(parse_float=Decimal)
-
+        return self.tx_details(txid, response)
+
+    def getaddrbytxs(self, txids):
+        responses = self.rpc_batch([("gettransaction", (txid,)) for txid in txids])
+        details = {}
+        for txid, response in zip(txids, responses):
+            try:
+                details[txid] = self.tx_details(txid, response)
+            except Exception:
+                continue
+        return details
+
+    def tx_details(self, txid, response):
         if response["error"]:
             raise Exception(
                 f"failed to get details of txid {txid}: {response['error']=}"
@@ -109,6 +136,41 @@ class BitcoinLikeCrypto(Crypto):
         _, _, confirmations, _ = self.getaddrbytx(txid)[0]
         return confirmations
 
+    def get_confirmations_by_txids(self, txids):
+        confirmations, _ = self.get_confirmations_and_tip(txids, with_tip=False)
+        return confirmations
+
+    def get_confirmations_and_tip(self, txids, with_tip=True):
+        calls = [("gettransaction", (txid,)) for txid in txids]
+        if with_tip:
+            # the node runs a batch in order, so the tip is read last
+            calls.append(("getblockcount", ()))
+        responses = self.rpc_batch(calls)
+
+        tip = None
+        if with_tip:
+            response = responses.pop()
+            if response["error"]:
+                raise Exception(f"failed to get block count: {response['error']=}")
+            tip = response["result"]
+
+        confirmations = {
+            txid: response["result"]["confirmations"]
+            for txid, response in zip(txids, responses)
+            if not response["error"]
+        }
+        return confirmations, tip
+
+    def get_chain_tip(self):
+        response = requests.post(
+            "http://" + self.gethost(),
+            auth=self.get_rpc_credentials(),
+            json=self.build_rpc_request("getblockcount"),
+        ).json(parse_float=Decimal)
+        if response["error"]:
+            raise Exception(f"failed to get block count: {response['error']=}")
+        return response["result"]
+
     def create_wallet(self, name="shkeeper"):
         response = requests.post(
             "http://" + self.gethost(),
@@ -156,3 +218,28 @@ class BitcoinLikeCrypto(Crypto):
 
     def build_rpc_request(self, method, *params):
         return {"jsonrpc": "1.0", "id": "shkeeper", "method": method, "params": params}
+
+    def rpc_batch(self, calls, **kwargs):
+        """Send several RPC calls in a single JSON-RPC batch request.
+
+        calls is a list of (method, params) tuples. Returns the response of
+        every call, each with its own result and error, in the order of calls.
+        """
+        if not calls:
+            return []
+
+        batch = [
+            dict(self.build_rpc_request(method, *params), id=i)
+            for i, (method, params) in enumerate(calls)
+        ]
+        responses = requests.post(
+            "http://" + self.gethost(),
+            auth=self.get_rpc_credentials(),
+            json=batch,
+            **kwargs,
+        ).json(parse_float=Decimal)
+        if not isinstance(responses, list):
+            raise Exception(f"batch request failed: {responses=}")
+
+        by_id = {response["id"]: response for response in responses}
+        return [by_id[i] for i in range(len(calls))]
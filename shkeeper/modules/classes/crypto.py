@@ -116,6 +116,47 @@ class Crypto(abc.ABC):
     def get_all_addresses(self):
         pass
 
+    def get_chain_tip(self):
+        """Height of the best block, None if the backend can't tell.
+
+        Transactions of cryptos without a chain tip get their confirmations
+        from get_confirmations_by_txid() on every update.
+        """
+        return None
+
+    def get_confirmations_by_txids(self, txids):
+        """Confirmations of several transactions as a {txid: confirmations} dict.
+
+        Transactions that can't be looked up are left out.
+        """
+        confirmations = {}
+        for txid in txids:
+            try:
+                confirmations[txid] = self.get_confirmations_by_txid(txid)
+            except Exception:
+                continue
+        return confirmations
+
+    def getaddrbytxs(self, txids):
+        """getaddrbytx() of several transactions as a {txid: details} dict.
+
+        Transactions that can't be looked up are left out.
+        """
+        details = {}
+        for txid in txids:
+            try:
+                details[txid] = self.getaddrbytx(txid)
+            except Exception:
+                continue
+        return details
+
+    def get_confirmations_and_tip(self, txids):
+        """get_confirmations_by_txids() and get_chain_tip(), in that order."""
+        return self.get_confirmations_by_txids(txids), self.get_chain_tip()
+
+    def balance_and_status(self):
+        return self.balance(), self.getstatus()
+
     @property
     def wallet(self):
         return self._wallet.query.filter_by(crypto=self.crypto).first()
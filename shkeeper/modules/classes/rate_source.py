@@ -3,6 +3,7 @@ from abc import ABCMeta, abstractmethod
 
 class RateSource(metaclass=ABCMeta):
     instances = {}
+    stream = None
 
     USDT_CRYPTOS = {"USDT", "ETH-USDT", "BNB-USDT", "POLYGON-USDT", "AVALANCHE-USDT", "ETH-PYUSD", "SOLANA-PYUSD", "SOLANA-USDT"}
     USDC_CRYPTOS = {"ETH-USDC", "BNB-USDC", "POLYGON-USDC", "AVALANCHE-USDC", "SOLANA-USDC"}
@@ -14,6 +15,31 @@ class RateSource(metaclass=ABCMeta):
         instance = cls()
         cls.instances[instance.name] = instance
 
+    @classmethod
+    def normalize_symbol(cls, crypto):
+        if crypto in cls.USDT_CRYPTOS:
+            return "USDT"
+        if crypto in cls.USDC_CRYPTOS:
+            return "USDC"
+        if crypto in cls.BTC_CRYPTOS:
+            return "BTC"
+        if crypto in cls.FIRO_CRYPTOS:
+            return "FIRO"
+        return crypto
+
     @abstractmethod
     def get_rate(self, fiat, crypto):
         pass
+
+    def get_rates(self, fiat, cryptos):
+        """Return {crypto: rate} for every crypto the provider has a price for.
+
+        Providers with a multi-symbol endpoint override this to make a single request.
+        """
+        rates = {}
+        for crypto in cryptos:
+            try:
+                rates[crypto] = self.get_rate(fiat, crypto)
+            except Exception:
+                continue
+        return rates
@@ -0,0 +1,144 @@
+import json
+import random
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+
+
+class RateStream(metaclass=ABCMeta):
+    """
+    Keeps a websocket ticker subscription open in a background thread and
+    maintains an in-memory price book, so a rate source can answer get_rate()
+    with a dictionary read.
+
+    Prices older than max_age are treated as missing and the rate source falls
+    back to its REST API. The connection is re-established with exponential
+    backoff whenever it drops or stays silent for max_age seconds.
+
+    connect(url, timeout) opens the connection, websocket-client's
+    create_connection by default. The result needs send(), recv() and close().
+    """
+
+    url = None
+    MAX_BACKOFF = 60
+
+    def __init__(self, symbols, logger, url=None, max_age=30, connect=None):
+        self.symbols = sorted(symbols)
+        self.logger = logger
+        self.url = url or self.url
+        self.max_age = max_age
+        self.connect = connect or create_connection
+        self._book = {}
+        self._stop = threading.Event()
+        self._ws = None
+        self._thread = None
+
+    def price(self, symbol):
+        if entry := self._book.get(symbol):
+            price, updated_at = entry
+            if time.monotonic() - updated_at < self.max_age:
+                return price
+        return None
+
+    def update(self, symbol, price):
+        self._book[symbol] = (price, time.monotonic())
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.run, name=f"{self.__class__.__name__}", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._ws:
+            self._ws.close()
+
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                self._ws = self.connect(self.url, timeout=self.max_age)
+                for message in self.subscribe_messages():
+                    self._ws.send(json.dumps(message))
+                self.logger.info(
+                    f"[{self.__class__.__name__}] Subscribed to {len(self.symbols)} tickers at {self.url}"
+                )
+                backoff = 1
+                while not self._stop.is_set():
+                    self.handle(json.loads(self._ws.recv()))
+            except Exception as e:
+                if self._stop.is_set():
+                    break
+                self.logger.warning(
+                    f"[{self.__class__.__name__}] Connection lost, reconnecting in {backoff}s: {e}"
+                )
+            finally:
+                if self._ws:
+                    self._ws.close()
+                    self._ws = None
+
+            self._stop.wait(backoff + random.uniform(0, backoff / 2))
+            backoff = min(backoff * 2, self.MAX_BACKOFF)
+
+    @abstractmethod
+    def subscribe_messages(self):
+        pass
+
+    @abstractmethod
+    def handle(self, message):
+        pass
+
+
+def create_connection(url, timeout):
+    import websocket
+
+    return websocket.create_connection(url, timeout=timeout)
+
+
+def start_rate_streams(app, connect=None):
+    """Start streams for the rate sources listed in RATE_STREAM_SOURCES.
+
+    Called by the rate_streams scheduler task, so only processes running the
+    scheduler open connections. connect is passed on to RateStream.
+    """
+    from shkeeper import cross_rates
+    from shkeeper.models import Fiat
+    from shkeeper.modules.classes.crypto import Crypto
+    from shkeeper.modules.classes.rate_source import RateSource
+
+    if connect is None:
+        try:
+            import websocket
+        except ImportError:
+            if app.config["RATE_STREAM_SOURCES"]:
+                app.logger.warning(
+                    "RATE_STREAM_SOURCES is set but websocket-client is not installed"
+                )
+            return
+
+    fiats = {cross_rates.quote_fiat(fiat) for fiat in Fiat.list()}
+    for name in app.config["RATE_STREAM_SOURCES"]:
+        source = RateSource.instances.get(name)
+        if not getattr(source, "stream_class", None):
+            app.logger.warning(f"Rate source {name} does not support streaming")
+            continue
+        if source.stream and source.stream.running():
+            continue
+
+        symbols = {
+            source.stream_symbol(fiat, crypto)
+            for crypto in Crypto.instances
+            for fiat in fiats
+        } - {None}
+        source.stream = source.stream_class(
+            symbols,
+            app.logger,
+            url=app.config["RATE_STREAM_WS_URLS"].get(name),
+            max_age=app.config["RATE_STREAM_MAX_AGE"],
+            connect=connect,
+        )
+        source.stream.start()
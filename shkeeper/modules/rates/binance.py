@@ -4,10 +4,29 @@ from decimal import Decimal
 from shkeeper import requests
 
 from shkeeper.modules.classes.rate_source import RateSource
+from shkeeper.modules.classes.rate_stream import RateStream
+
+
+class BinanceStream(RateStream):
+    url = "wss://stream.binance.com:9443/ws"
+
+    def subscribe_messages(self):
+        streams = [f"{symbol.lower()}@miniTicker" for symbol in self.symbols]
+        return [{"method": "SUBSCRIBE", "params": streams, "id": 1}]
+
+    def handle(self, message):
+        if message.get("e") == "24hrMiniTicker":
+            self.update(message["s"], Decimal(message["c"]))
 
 
 class Binance(RateSource):
     name = "binance"
+    stream_class = BinanceStream
+
+    def stream_symbol(self, fiat, crypto):
+        if fiat == "USD" and crypto in self.USDT_CRYPTOS:
+            return None
+        return f"{self.normalize_symbol(crypto)}{'USDT' if fiat == 'USD' else fiat}"
 
     def get_rate(self, fiat, crypto):
         if fiat == "USD" and crypto in self.USDT_CRYPTOS:
@@ -25,6 +44,9 @@ class Binance(RateSource):
         if fiat == "USD":
             fiat = "USDT"
 
+        if self.stream and (price := self.stream.price(f"{crypto}{fiat}")) is not None:
+            return price
+
         url = f"https://api.binance.com/api/v3/ticker/price?symbol={crypto}{fiat}"
         answer = requests.get(url)
         if answer.status_code == requests.codes.ok:
@@ -32,3 +54,31 @@ class Binance(RateSource):
             return Decimal(data["price"])
 
         raise Exception(f"Can't get rate for {crypto}{fiat}")
+
+    def get_rates(self, fiat, cryptos):
+        rates = {}
+        symbols = {}
+        quote = "USDT" if fiat == "USD" else fiat
+        for crypto in cryptos:
+            if fiat == "USD" and crypto in self.USDT_CRYPTOS:
+                rates[crypto] = Decimal(1.0)
+            else:
+                symbol = f"{self.normalize_symbol(crypto)}{quote}"
+                if self.stream and (price := self.stream.price(symbol)) is not None:
+                    rates[crypto] = price
+                else:
+                    symbols[crypto] = symbol
+
+        if not symbols:
+            return rates
+
+        # A single unknown symbol fails the whole ?symbols= request, so fetch all tickers
+        answer = requests.get("https://api.binance.com/api/v3/ticker/price")
+        if answer.status_code != requests.codes.ok:
+            raise Exception(f"Can't get rates for {fiat}: HTTP {answer.status_code}")
+
+        prices = {t["symbol"]: t["price"] for t in json.loads(answer.text)}
+        for crypto, symbol in symbols.items():
+            if symbol in prices:
+                rates[crypto] = Decimal(prices[symbol])
+        return rates
@@ -38,3 +38,27 @@ class Coinbase(RateSource):
             return Decimal(rates["USDT"])
 
         raise Exception(f"Can't get rate for {crypto} / {fiat}: pair not found in Coinbase response")
+
+    def get_rates(self, fiat, cryptos):
+        rates = {}
+        symbols = {}
+        for crypto in cryptos:
+            if fiat == "USD" and crypto in self.USDT_CRYPTOS:
+                rates[crypto] = Decimal(1.0)
+            else:
+                symbols[crypto] = self.normalize_symbol(crypto)
+
+        if not symbols:
+            return rates
+
+        # Quoting in the fiat returns how much of every asset one unit of fiat buys
+        url = f"https://api.coinbase.com/v2/exchange-rates?currency={fiat}"
+        answer = requests.get(url)
+        if answer.status_code != requests.codes.ok:
+            raise Exception(f"Can't get rates for {fiat}: HTTP {answer.status_code}")
+
+        amounts = json.loads(answer.text).get("data", {}).get("rates", {})
+        for crypto, symbol in symbols.items():
+            if Decimal(amounts.get(symbol, 0)) > 0:
+                rates[crypto] = 1 / Decimal(amounts[symbol])
+        return rates
@@ -0,0 +1,144 @@
+import statistics
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from decimal import Decimal
+
+import prometheus_client
+from flask import current_app as app
+
+from shkeeper.modules.classes.rate_source import RateSource
+
+
+provider_latency = prometheus_client.Histogram(
+    "shkeeper_rate_provider_latency_seconds",
+    "Time spent waiting for a rate provider answer",
+    ["provider"],
+)
+provider_errors = prometheus_client.Counter(
+    "shkeeper_rate_provider_errors_total",
+    "Rate provider requests that failed or returned no usable price",
+    ["provider"],
+)
+
+
+class Composite(RateSource):
+    """Asks several providers at once and answers within RATE_COMPOSITE_DEADLINE.
+
+    RATE_COMPOSITE_STRATEGY=first returns the first valid price,
+    RATE_COMPOSITE_STRATEGY=median returns the median of the prices received in time.
+
+    Requests still running after the deadline keep an executor worker, so a
+    provider with RATE_COMPOSITE_PROVIDER_INFLIGHT requests in flight is not
+    asked again until one of them returns.
+    """
+
+    name = "composite"
+    executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="composite-rate")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    @property
+    def providers(self):
+        return [
+            RateSource.instances[name]
+            for name in app.config["RATE_COMPOSITE_PROVIDERS"]
+            if name in RateSource.instances and name not in (self.name, "manual")
+        ]
+
+    @property
+    def strategy(self):
+        return app.config["RATE_COMPOSITE_STRATEGY"]
+
+    @property
+    def deadline(self):
+        return app.config["RATE_COMPOSITE_DEADLINE"]
+
+    def get_rate(self, fiat, crypto):
+        answers = self.ask(
+            lambda provider: provider.get_rate(fiat, crypto),
+            lambda answers: self.strategy == "first"
+            and any(self.is_valid(price) for price in answers),
+        )
+        prices = [price for price in answers if self.is_valid(price)]
+        if not prices:
+            raise Exception(
+                f"Can't get rate for {crypto} / {fiat} from "
+                f"{[p.name for p in self.providers]}"
+            )
+        return self.select(prices)
+
+    def get_rates(self, fiat, cryptos):
+        def covered(answers):
+            found = set().union(*(rates.keys() for rates in answers))
+            return self.strategy == "first" and found >= set(cryptos)
+
+        answers = self.ask(lambda provider: provider.get_rates(fiat, cryptos), covered)
+        rates = {}
+        for crypto in cryptos:
+            prices = [r[crypto] for r in answers if self.is_valid(r.get(crypto))]
+            if prices:
+                rates[crypto] = self.select(prices)
+        return rates
+
+    def ask(self, call, enough):
+        """Call every provider concurrently, collecting answers in arrival order
+        until enough(answers) is true, all providers answered or the deadline passed."""
+        until = time.monotonic() + self.deadline
+        limit = app.config["RATE_COMPOSITE_PROVIDER_INFLIGHT"]
+        pending = set()
+        for provider in self.providers:
+            if future := self.submit(provider, call, limit):
+                pending.add(future)
+        answers = []
+        while pending:
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    answers.append(future.result())
+            if enough(answers):
+                break
+        return answers
+
+    def submit(self, provider, call, limit):
+        """Start call(provider) unless limit requests to provider are running."""
+        with self._lock:
+            if self._inflight.get(provider.name, 0) >= limit:
+                return None
+            self._inflight[provider.name] = self._inflight.get(provider.name, 0) + 1
+
+        def done(_):
+            with self._lock:
+                self._inflight[provider.name] -= 1
+
+        future = self.executor.submit(self.measure, provider, call)
+        future.add_done_callback(done)
+        return future
+
+    def select(self, prices):
+        if self.strategy == "median":
+            return Decimal(statistics.median(prices))
+        return prices[0]
+
+    @staticmethod
+    def is_valid(price):
+        return isinstance(price, Decimal) and price.is_finite() and price > 0
+
+    @staticmethod
+    def measure(provider, call):
+        started = time.monotonic()
+        try:
+            result = call(provider)
+        except Exception:
+            provider_errors.labels(provider.name).inc()
+            raise
+        finally:
+            provider_latency.labels(provider.name).observe(time.monotonic() - started)
+        if not result:
+            provider_errors.labels(provider.name).inc()
+        return result
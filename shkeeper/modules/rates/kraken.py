@@ -3,10 +3,36 @@ from decimal import Decimal
 
 from shkeeper import requests
 from shkeeper.modules.classes.rate_source import RateSource
+from shkeeper.modules.classes.rate_stream import RateStream
+
+
+class KrakenStream(RateStream):
+    # https://docs.kraken.com/api/docs/websocket-v2/ticker
+    url = "wss://ws.kraken.com/v2"
+
+    def subscribe_messages(self):
+        return [
+            {
+                "method": "subscribe",
+                "params": {"channel": "ticker", "symbol": self.symbols},
+            }
+        ]
+
+    def handle(self, message):
+        if message.get("channel") == "ticker":
+            for ticker in message.get("data", []):
+                self.update(ticker["symbol"], Decimal(str(ticker["last"])))
 
 
 class Kraken(RateSource):
     name = "kraken"
+    ASSET_ALIASES = {"BTC": "XBT", "DOGE": "XDG"}
+    stream_class = KrakenStream
+
+    def stream_symbol(self, fiat, crypto):
+        if fiat == "USD" and crypto in self.USDT_CRYPTOS:
+            return None
+        return f"{self.normalize_symbol(crypto)}/{'USDT' if fiat == 'USD' else fiat}"
 
     def get_rate(self, fiat, crypto):
         if fiat == "USD" and crypto in self.USDT_CRYPTOS:
@@ -23,6 +49,10 @@ class Kraken(RateSource):
 
         if fiat == "USD":
             fiat = "USDT"
+
+        if self.stream and (price := self.stream.price(f"{crypto}/{fiat}")) is not None:
+            return price
+
         url = f"https://api.kraken.com/0/public/Ticker?pair={crypto}{fiat}"
         answer = requests.get(url)
         if answer.status_code == requests.codes.ok:
@@ -33,3 +63,45 @@ class Kraken(RateSource):
                 return Decimal(data["result"][key]["c"][0])
 
         raise Exception(f"Can't get rate for {crypto} / {fiat}")
+
+    def get_rates(self, fiat, cryptos):
+        rates = {}
+        pairs = {}
+        quote = "USDT" if fiat == "USD" else fiat
+        for crypto in cryptos:
+            if fiat == "USD" and crypto in self.USDT_CRYPTOS:
+                rates[crypto] = Decimal(1.0)
+            elif self.stream and (
+                price := self.stream.price(f"{self.normalize_symbol(crypto)}/{quote}")
+            ) is not None:
+                rates[crypto] = price
+            else:
+                pairs[crypto] = self.pair_names(self.normalize_symbol(crypto), quote)
+
+        if not pairs:
+            return rates
+
+        # Unknown pairs fail the whole ?pair= request, so fetch all tickers
+        answer = requests.get("https://api.kraken.com/0/public/Ticker")
+        if answer.status_code != requests.codes.ok:
+            raise Exception(f"Can't get rates for {fiat}: HTTP {answer.status_code}")
+        data = json.loads(answer.text)
+        if data["error"]:
+            raise Exception(f"Can't get rates for {fiat}: {data['error']}")
+
+        for crypto, names in pairs.items():
+            for name in names:
+                if name in data["result"]:
+                    rates[crypto] = Decimal(data["result"][name]["c"][0])
+                    break
+        return rates
+
+    def pair_names(self, crypto, fiat):
+        """Names Kraken may use for a pair in Ticker results, e.g. BTCUSDT -> XBTUSDT or XXBTZUSD."""
+        asset = self.ASSET_ALIASES.get(crypto, crypto)
+        return [
+            f"{asset}{fiat}",
+            f"X{asset}Z{fiat}",
+            f"X{asset}{fiat}",
+            f"{crypto}{fiat}",
+        ]
@@ -34,3 +34,22 @@ class KuCoin(RateSource):
                     return Decimal(price)
 
         raise Exception(f"Can't get rate for {crypto} in {fiat}")
+
+    def get_rates(self, fiat, cryptos):
+        symbols = {crypto: self.normalize_symbol(crypto) for crypto in cryptos}
+        currencies = ",".join(sorted(set(symbols.values())))
+        url = f"https://api.kucoin.com/api/v1/prices?base={fiat}&currencies={currencies}"
+        answer = requests.get(url)
+        if answer.status_code != requests.codes.ok:
+            raise Exception(f"Can't get rates in {fiat}: HTTP {answer.status_code}")
+
+        data = json.loads(answer.text)
+        if data.get("code") != "200000":
+            raise Exception(f"Can't get rates in {fiat}: {data}")
+
+        prices = data.get("data") or {}
+        return {
+            crypto: Decimal(prices[symbol])
+            for crypto, symbol in symbols.items()
+            if prices.get(symbol) is not None
+        }
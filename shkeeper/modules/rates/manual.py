@@ -11,3 +11,6 @@ class Manual(RateSource):
 
     def get_rate(self, fiat, crypto):
         raise Exception(f"Manual rate provider has no get_rate()")
+
+    def get_rates(self, fiat, cryptos):
+        return {}
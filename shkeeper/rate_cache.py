@@ -0,0 +1,137 @@
+"""
+Exchange Rate Cache
+
+Keeps the last price received from every rate provider in memory, so invoice
+creation, quotes and the rates pages don't pay for an exchange round trip.
+
+Entries are keyed by (source, fiat, normalized symbol). A fresh entry is served
+as is; an entry older than RATE_CACHE_TTL but younger than
+RATE_CACHE_TTL + RATE_CACHE_STALE_TTL is served while a background thread
+fetches a new price (stale-while-revalidate); anything older is fetched inline.
+The "rates" scheduler task keeps the configured pairs warm.
+"""
+
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+from flask import current_app as app
+
+
+CachedRate = namedtuple("CachedRate", "price fetched_at")
+
+
+class RateCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rates = {}
+        self._refreshing = set()
+
+    @staticmethod
+    def key(source, fiat, crypto):
+        return (source.name, fiat, source.normalize_symbol(crypto))
+
+    def get_rate(self, source, fiat, crypto):
+        ttl = app.config.get("RATE_CACHE_TTL")
+        if not ttl:
+            return source.get_rate(fiat, crypto)
+
+        key = self.key(source, fiat, crypto)
+        cached = self._rates.get(key)
+        if cached:
+            age = time.monotonic() - cached.fetched_at
+            if age < ttl:
+                return cached.price
+            if age < ttl + app.config.get("RATE_CACHE_STALE_TTL"):
+                self._refresh_in_background(source, fiat, crypto)
+                return cached.price
+
+        return self.refresh(source, fiat, crypto)
+
+    def get_rates(self, source, fiat, cryptos):
+        """Bulk get_rate(): every missing or stale price is fetched in one provider call."""
+        ttl = app.config.get("RATE_CACHE_TTL")
+        now = time.monotonic()
+        rates = {}
+        missing = []
+        for crypto in cryptos:
+            cached = self._rates.get(self.key(source, fiat, crypto))
+            if ttl and cached and now - cached.fetched_at < ttl:
+                rates[crypto] = cached.price
+            else:
+                missing.append(crypto)
+
+        if missing:
+            rates.update(self.refresh_many(source, fiat, missing))
+        return rates
+
+    def refresh(self, source, fiat, crypto):
+        price = source.get_rate(fiat, crypto)
+        self.put(source, fiat, crypto, price)
+        return price
+
+    def refresh_many(self, source, fiat, cryptos):
+        rates = source.get_rates(fiat, cryptos)
+        for crypto, price in rates.items():
+            self.put(source, fiat, crypto, price)
+        return rates
+
+    def put(self, source, fiat, crypto, price):
+        with self._lock:
+            self._rates[self.key(source, fiat, crypto)] = CachedRate(
+                price, time.monotonic()
+            )
+
+    def invalidate(self):
+        with self._lock:
+            self._rates.clear()
+
+    def _refresh_in_background(self, source, fiat, crypto):
+        key = self.key(source, fiat, crypto)
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        flask_app = app._get_current_object()
+
+        def refresh():
+            try:
+                with flask_app.app_context():
+                    self.refresh(source, fiat, crypto)
+            except Exception as e:
+                flask_app.logger.warning(f"[RateCache] Failed to refresh {key}: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def warm(self):
+        """Fetch fresh prices for every dynamic rate configured for an enabled crypto."""
+        from shkeeper import cross_rates
+        from shkeeper.models import ExchangeRate
+        from shkeeper.modules.classes.crypto import Crypto
+
+        pairs = defaultdict(set)
+        for rate in ExchangeRate.query.filter(ExchangeRate.source != "manual"):
+            if rate.crypto in Crypto.instances:
+                fiat = cross_rates.quote_fiat(rate.fiat)
+                pairs[(rate.rate_source, fiat)].add(rate.crypto)
+
+        # one request per provider and fiat
+        for (source, fiat), cryptos in pairs.items():
+            try:
+                rates = self.refresh_many(source, fiat, cryptos)
+            except Exception as e:
+                app.logger.warning(
+                    f"[RateCache] Failed to refresh {source.name} {fiat} rates: {e}"
+                )
+                continue
+            if missing := cryptos - rates.keys():
+                app.logger.warning(
+                    f"[RateCache] {source.name} has no {fiat} rate for {sorted(missing)}"
+                )
+
+
+rate_cache = RateCache()
@@ -1,4 +1,4 @@
-function changeSource(ind) {
+function changeSource(ind, initial = false) {
     let rate_inputs = document.getElementsByClassName("rates-cost-value");
 
     let sourceType = selectArray[ind].value;
@@ -9,6 +9,10 @@ function changeSource(ind) {
     } else {
         delete rate_inputs[ind].dataset.manual
         rate_inputs[ind].readOnly = true
+        // live rates are rendered with the page, fetch only when the source changes
+        if (initial && rate_inputs[ind].value) {
+            return;
+        }
         getRealTRates(rate_inputs[ind].dataset.pairname.toLowerCase(), rate_inputs[ind]);
     }
 }
@@ -63,7 +67,7 @@ function getRealTRates(pairName, currentRate) {
 let selectArray = document.getElementsByClassName("select-rate");
 for (let i = 0; i < selectArray.length; i++) {
     selectArray[i].addEventListener("change", function () { changeSource(i); });
-    changeSource(i);
+    changeSource(i, true);
 }
 
 let selectArray2 = document.getElementsByClassName("fee_policy_select");
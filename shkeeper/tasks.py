@@ -3,7 +3,11 @@ from datetime import timedelta, datetime
 
 from flask_apscheduler import APScheduler
 
-from shkeeper import scheduler, callback
+from shkeeper import scheduler, callback, walletnotify
+from shkeeper.rate_cache import rate_cache
+from shkeeper.address_index import address_index
+from shkeeper.cross_rates import fx_table
+from shkeeper.modules.classes.rate_stream import start_rate_streams
 from shkeeper.modules.classes.crypto import Crypto
 from shkeeper.models import *
 
@@ -11,10 +15,68 @@ from shkeeper.models import *
 @scheduler.task("interval", id="callback", seconds=60)
 def task_callback():
     with scheduler.app.app_context():
-        callback.update_confirmations()
         callback.send_callbacks()
 
 
+@scheduler.task(
+    "interval",
+    id="confirmations",
+    seconds=scheduler.app.config["CONFIRMATION_POLL_MIN"],
+)
+def task_confirmations():
+    with scheduler.app.app_context():
+        callback.update_confirmations()
+
+
+@scheduler.task(
+    "interval",
+    id="rates",
+    seconds=scheduler.app.config["RATE_CACHE_REFRESH_INTERVAL"],
+)
+def task_refresh_rates():
+    with scheduler.app.app_context():
+        if scheduler.app.config.get("RATE_CROSS_FIAT"):
+            try:
+                fx_table.refresh_if_expired()
+            except Exception as e:
+                scheduler.app.logger.warning(f"[FX] Failed to refresh FX rates: {e}")
+        if not scheduler.app.config.get("RATE_CACHE_TTL"):
+            return
+        rate_cache.warm()
+
+
+@scheduler.task("date", id="rate_streams")
+def task_rate_streams():
+    with scheduler.app.app_context():
+        start_rate_streams(scheduler.app)
+
+
+@scheduler.task(
+    "interval",
+    id="rate_history",
+    seconds=scheduler.app.config["RATE_HISTORY_INTERVAL"] or 300,
+)
+def task_rate_history():
+    with scheduler.app.app_context():
+        if not scheduler.app.config.get("RATE_HISTORY_INTERVAL"):
+            return
+        RateHistory.sample()
+        if days := scheduler.app.config.get("RATE_HISTORY_RETENTION_DAYS"):
+            RateHistory.purge(datetime.now() - timedelta(days=days))
+
+
+@scheduler.task("interval", id="walletnotify", seconds=10)
+def task_walletnotify():
+    with scheduler.app.app_context():
+        walletnotify.process_due()
+
+
+@scheduler.task("interval", id="address_index", seconds=60)
+def task_address_index():
+    with scheduler.app.app_context():
+        address_index.refresh()
+
+
 @scheduler.task("interval", id="payout", seconds=60)
 def task_payout():
     scheduler.app.logger.info(f"[Autopayout] Task started")
@@ -25,10 +87,11 @@ def task_payout():
                     f"[Autopayout] {crypto.crypto} payout policy is {crypto.wallet.ppolicy}"
                 )
                 limit = Decimal(crypto.wallet.pcond)
-                if crypto.balance() >= limit:
+                balance = crypto.balance()
+                if balance >= limit:
                     scheduler.app.logger.info(
                         f"[Autopayout] {crypto.crypto} payout limit reached. "
-                        f"Need: {limit}, has: {crypto.balance()}"
+                        f"Need: {limit}, has: {balance}"
                     )
                     res = crypto.wallet.do_payout()
                     scheduler.app.logger.info(
@@ -37,7 +100,7 @@ def task_payout():
                 else:
                     scheduler.app.logger.info(
                         f"[Autopayout] {crypto.crypto} payout limit is not reached. "
-                        f"Need: {limit}, has: {crypto.balance()}"
+                        f"Need: {limit}, has: {balance}"
                     )
 
             elif crypto.wallet.ppolicy == PayoutPolicy.SCHEDULED:
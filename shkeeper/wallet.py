@@ -30,6 +30,8 @@ from shkeeper.wallet_encryption import (
 from .modules.classes.tron_token import TronToken
 from .modules.classes.ethereum import Ethereum
 from shkeeper.modules.rates import RateSource
+from shkeeper import cross_rates
+from shkeeper.webhook_breaker import webhook_breakers
 from shkeeper.modules.classes.crypto import Crypto
 from shkeeper.models import (
     FeeCalculationPolicy,
@@ -45,6 +47,8 @@ from shkeeper.models import (
     ExchangeRate,
     InvoiceStatus,
     Transaction,
+    WebhookOutbox,
+    WebhookOutboxStatus,
     # Multi-tenant models
     Merchant,
     MerchantStatus,
@@ -164,12 +168,26 @@ def manage(crypto_name):
 @login_required
 def list_rates(fiat):
     cryptos = copy.deepcopy(Crypto.instances).values()
+    by_source = defaultdict(list)
     for crypto in cryptos:
-        rate = ExchangeRate.get(fiat, crypto.crypto)
+        rate = ExchangeRate.query.filter_by(fiat=fiat, crypto=crypto.crypto).first()
+        if not rate:
+            raise Exception(f"Exchange rate src config for {fiat}-{crypto.crypto} is not found")
         if rate.fee_policy is None:
             rate.fee_policy = FeeCalculationPolicy.PERCENT_FEE
             db.session.commit()
         crypto.rate = rate
+        if rate.source != "manual":
+            by_source[rate.rate_source].append(crypto.crypto)
+
+    live_rates = {}
+    for source, symbols in by_source.items():
+        try:
+            live_rates.update(cross_rates.get_rates(source, fiat, symbols))
+        except Exception as e:
+            app.logger.warning(f"Failed to get {source.name} rates: {e}")
+    for crypto in cryptos:
+        crypto.live_rate = live_rates.get(crypto.crypto)
 
     return render_template(
         "wallet/rates.j2",
@@ -205,6 +223,7 @@ def save_rates(fiat):
 
         ExchangeRate.query.filter_by(crypto=symbol, fiat=fiat).update(fields)
     db.session.commit()
+    ExchangeRate.rebuild_snapshot()
     return redirect(url_for("wallet.list_rates"))
 
 
@@ -676,6 +695,23 @@ def admin_merchant_detail(merchant_id):
         "commission_by_fiat": commission_by_fiat,
     }
 
+    # Webhook delivery state of the hosts this merchant is notified at
+    pending_webhooks = dict(
+        db.session.query(WebhookOutbox.callback_url, db.func.count(WebhookOutbox.id))
+        .filter(
+            WebhookOutbox.merchant_id == merchant_id,
+            WebhookOutbox.status == WebhookOutboxStatus.PENDING,
+        )
+        .group_by(WebhookOutbox.callback_url)
+        .all()
+    )
+    webhook_hosts = {}
+    for url in [merchant.callback_url_base, *pending_webhooks]:
+        if url:
+            host = webhook_breakers.status(url)
+            host = webhook_hosts.setdefault(host["host"], {**host, "pending": 0})
+            host["pending"] += pending_webhooks.get(url, 0)
+
     return render_template(
         "admin/merchant_detail.j2",
         merchant=merchant,
@@ -684,6 +720,7 @@ def admin_merchant_detail(merchant_id):
         recent_invoices=recent_invoices,
         recent_payouts=recent_payouts,
         stats=stats,
+        webhook_hosts=webhook_hosts.values(),
     )
 
 
@@ -0,0 +1,471 @@
+"""
+Walletnotify Processing
+
+Turns a transaction notification from a crypto backend into Transaction /
+UnconfirmedTransaction rows and merchant notifications.
+
+With WALLETNOTIFY_ASYNC enabled the walletnotify endpoint only queues the
+(crypto, txid) pair in WalletNotification and answers 202. Queued pairs are
+processed by at most WALLETNOTIFY_WORKERS worker threads, so backends are
+never kept waiting on node RPC calls or the database. The "walletnotify"
+scheduler task picks up retries and whatever was queued before a restart.
+"""
+
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app as app
+from flask_sqlalchemy import sqlalchemy
+
+from shkeeper import db
+from shkeeper.callback import notify, notify_unconfirmed, settle_commission
+from shkeeper.confirmation_scheduler import confirmation_scheduler
+from shkeeper.exceptions import NotRelatedToAnyInvoice
+from shkeeper.models import (
+    ExchangeRate,
+    Invoice,
+    Transaction,
+    UnconfirmedTransaction,
+    WalletNotification,
+)
+from shkeeper.modules.classes.crypto import Crypto
+
+
+def payment_rates(crypto, invoice):
+    """Rates Transaction.add and Invoice.update_with_tx need to store a
+    payment to invoice, looked up before the invoice gets locked."""
+    now = datetime.now()
+    rate = recalc_rate = None
+    if invoice.crypto != crypto.crypto:
+        rate = ExchangeRate.get(invoice.fiat, crypto.crypto).get_rate_at(now)
+    if invoice.recalc_due():
+        recalc_rate = invoice.rate.get_rate_at(now)
+    return rate, recalc_rate
+
+
+def payout_rate(crypto, rows):
+    """Rate Transaction.add_outgoing needs if rows contain a payout."""
+    if any(row[-1] == "send" for row in rows):
+        return ExchangeRate.get("USD", crypto.crypto).get_rate_at(datetime.now())
+    return None
+
+
+def lock_invoices(invoice_ids):
+    """Lock invoices in id order, so concurrent notifications can't deadlock."""
+    for invoice_id in sorted(invoice_ids):
+        Invoice.lock(invoice_id)
+
+
+def process_walletnotify(crypto_name, txid):
+    """Process a transaction notification.
+
+    All outputs are written in one DB transaction, so a transaction is either
+    stored completely or processed again on its next notification.
+    Raises NotRelatedToAnyInvoice if the transaction doesn't pay an invoice.
+    """
+    crypto = Crypto.instances[crypto_name]
+    rows = crypto.getaddrbytx(txid)
+    invoices = Invoice.by_addresses(row[0] for row in rows if row[3] == "receive")
+    known = {
+        invoice_id
+        for (invoice_id,) in db.session.query(Transaction.invoice_id).filter_by(
+            crypto=crypto_name, txid=txid
+        )
+    }
+    known_unconfirmed = {
+        invoice_id
+        for (invoice_id,) in db.session.query(
+            UnconfirmedTransaction.invoice_id
+        ).filter_by(crypto=crypto_name, txid=txid)
+    }
+
+    # rate providers are asked before any invoice is locked
+    paid = {
+        invoice.id: payment_rates(crypto, invoice)
+        for addr, _, confirmations, category in rows
+        if category == "receive"
+        and confirmations > 0
+        and (invoice := invoices.get(addr))
+        and invoice.id not in known
+    }
+    outgoing_rate = payout_rate(crypto, rows)
+    lock_invoices(paid)
+
+    related = unrelated = False
+    added, unconfirmed = [], []
+    for addr, amount, confirmations, category in rows:
+        if category not in ("send", "receive"):
+            app.logger.warning(
+                f"[{crypto.crypto}/{txid}] ignoring unknown category: {category}"
+            )
+            continue
+
+        if category == "send":
+            Transaction.add_outgoing(
+                crypto, txid, rows, commit=False, rate=outgoing_rate
+            )
+            related = True
+            continue
+
+        invoice = invoices.get(addr)
+        if not invoice:
+            # other outputs of the transaction may still pay an invoice
+            unrelated = True
+            continue
+        related = True
+
+        if confirmations == 0:
+            app.logger.info(
+                f"[{crypto.crypto}/{txid}] TX has no confirmations yet (entered mempool)"
+            )
+
+            if (
+                app.config.get("UNCONFIRMED_TX_NOTIFICATION")
+                and invoice.id not in known_unconfirmed
+            ):
+                known_unconfirmed.add(invoice.id)
+                unconfirmed.append(
+                    UnconfirmedTransaction.add(
+                        crypto_name, txid, addr, amount, invoice=invoice, commit=False
+                    )
+                )
+            continue
+
+        if invoice.id in known:
+            app.logger.warning(f"[{crypto.crypto}/{txid}] TX already exist in db")
+            continue
+        known.add(invoice.id)
+
+        rate, recalc_rate = paid[invoice.id]
+        tx = Transaction.add(
+            crypto,
+            {
+                "txid": txid,
+                "addr": addr,
+                "amount": amount,
+                "confirmations": confirmations,
+            },
+            invoice=invoice,
+            commit=False,
+            rate=rate,
+        )
+        db.session.flush()
+        tx.invoice.update_with_tx(tx, commit=False, rate=recalc_rate)
+        if not tx.need_more_confirmations:
+            settle_commission(tx)
+        UnconfirmedTransaction.delete(crypto_name, txid, commit=False)
+        added.append(tx)
+
+    try:
+        db.session.commit()
+    except sqlalchemy.exc.IntegrityError:
+        # a concurrent notification of the same transaction stored it first
+        app.logger.warning(f"[{crypto.crypto}/{txid}] TX already exist in db")
+        db.session.rollback()
+        return
+
+    for utx in unconfirmed:
+        notify_unconfirmed(utx)
+    for tx in added:
+        app.logger.info(f"[{crypto.crypto}/{txid}] TX has been added to db")
+        if not tx.need_more_confirmations:
+            notify(tx)
+
+    if unrelated and not related:
+        if all(row[2] > 0 for row in rows):
+            seen_transactions.unrelated(crypto_name, txid)
+        raise NotRelatedToAnyInvoice(f"{txid} is not related to any invoice")
+
+
+class SeenTransactions:
+    """
+    Idempotency cache for walletnotify.
+
+    Backends notify a wallet transaction again on every confirmation. Once
+    its Transaction rows are stored nothing in a repeated notification can
+    change state: confirmations are tracked by update_confirmations(). Such
+    repeats are answered from an LRU of (crypto, txid) -> state, filled from
+    the Transaction table on a miss, without the getaddrbytx RPC. A repeat
+    of a transaction still short of the wallet's confirmations threshold
+    makes its crypto due for a confirmation poll, which picks up the
+    crossing; such transactions are looked up in the table again on every
+    repeat until they are confirmed. Confirmed transactions not related to
+    any invoice are remembered for WALLETNOTIFY_UNRELATED_TTL seconds. A
+    mempool notification is always processed, an invoice for its address may
+    not have been visible yet and the confirmation is the last notification.
+    """
+
+    PENDING = "pending"  # stored, needs more confirmations
+    DONE = "done"  # stored and confirmed
+    UNRELATED = "unrelated"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+
+    def _remember(self, key, state, expires=None):
+        with self._lock:
+            self._seen[key] = (state, expires)
+            self._seen.move_to_end(key)
+            while len(self._seen) > app.config["WALLETNOTIFY_CACHE_SIZE"]:
+                self._seen.popitem(last=False)
+
+    def _cached(self, key):
+        with self._lock:
+            state, expires = self._seen.get(key, (None, None))
+            if expires is not None and expires < time.monotonic():
+                del self._seen[key]
+                return None
+            if state:
+                self._seen.move_to_end(key)
+            return state
+
+    def state(self, crypto_name, txid):
+        key = (crypto_name, txid)
+        state = self._cached(key)
+        if state in (self.DONE, self.UNRELATED):
+            return state
+
+        stored = (
+            db.session.query(Transaction.need_more_confirmations)
+            .filter_by(crypto=crypto_name, txid=txid)
+            .all()
+        )
+        if not stored:
+            return None
+        state = self.PENDING if any(row[0] for row in stored) else self.DONE
+        self._remember(key, state)
+        return state
+
+    def should_process(self, crypto_name, txid):
+        """False if the notification can't change anything."""
+        state = self.state(crypto_name, txid)
+        if state == self.PENDING:
+            confirmation_scheduler.poke(crypto_name)
+        return state is None
+
+    def unrelated(self, crypto_name, txid):
+        self._remember(
+            (crypto_name, txid),
+            self.UNRELATED,
+            time.monotonic() + app.config["WALLETNOTIFY_UNRELATED_TTL"],
+        )
+
+
+seen_transactions = SeenTransactions()
+
+
+def process_walletnotify_batch(crypto_name, txids=(), details=None):
+    """Process notifications of several transactions in one DB transaction.
+
+    details maps a txid to its getaddrbytx() rows, other txids are looked up
+    on the node. Transactions already processed are skipped. Returns the
+    txids that were added, skipped, not related to any invoice and failed to
+    be looked up.
+    """
+    crypto = Crypto.instances[crypto_name]
+    skipped = [
+        txid
+        for txid in dict.fromkeys([*txids, *(details or {})])
+        if not seen_transactions.should_process(crypto_name, txid)
+    ]
+    details = {
+        txid: tx_rows
+        for txid, tx_rows in (details or {}).items()
+        if txid not in skipped
+    }
+    lookup = [
+        txid
+        for txid in dict.fromkeys(txids)
+        if txid not in details and txid not in skipped
+    ]
+    found = crypto.getaddrbytxs(lookup)
+    details.update(found)
+
+    rows = [(txid, *row) for txid, tx_rows in details.items() for row in tx_rows]
+    invoices = Invoice.by_addresses(row[1] for row in rows if row[4] == "receive")
+    known = set(
+        db.session.query(Transaction.txid, Transaction.invoice_id).filter(
+            Transaction.crypto == crypto_name, Transaction.txid.in_(details.keys())
+        )
+    )
+    known_unconfirmed = set(
+        db.session.query(
+            UnconfirmedTransaction.txid, UnconfirmedTransaction.invoice_id
+        ).filter(
+            UnconfirmedTransaction.crypto == crypto_name,
+            UnconfirmedTransaction.txid.in_(details.keys()),
+        )
+    )
+
+    # rate providers are asked before any invoice is locked
+    paid = {
+        invoice.id: invoice
+        for txid, addr, _, confirmations, category in rows
+        if category == "receive"
+        and confirmations > 0
+        and (invoice := invoices.get(addr))
+        and (txid, invoice.id) not in known
+    }
+    rates = {
+        invoice_id: payment_rates(crypto, invoice)
+        for invoice_id, invoice in paid.items()
+    }
+    outgoing_rate = payout_rate(crypto, rows)
+    lock_invoices(paid)
+
+    added, not_related, confirmed, unconfirmed = [], [], [], []
+    related = set()
+    for txid, addr, amount, confirmations, category in rows:
+        if category not in ("send", "receive"):
+            app.logger.warning(
+                f"[{crypto.crypto}/{txid}] ignoring unknown category: {category}"
+            )
+            continue
+
+        if category == "send":
+            Transaction.add_outgoing(
+                crypto, txid, details[txid], commit=False, rate=outgoing_rate
+            )
+            related.add(txid)
+            continue
+
+        invoice = invoices.get(addr)
+        if not invoice:
+            not_related.append(txid)
+            continue
+        related.add(txid)
+
+        if confirmations == 0:
+            if (
+                app.config.get("UNCONFIRMED_TX_NOTIFICATION")
+                and (txid, invoice.id) not in known_unconfirmed
+            ):
+                known_unconfirmed.add((txid, invoice.id))
+                unconfirmed.append(
+                    UnconfirmedTransaction.add(
+                        crypto_name, txid, addr, amount, invoice=invoice, commit=False
+                    )
+                )
+            continue
+
+        if (txid, invoice.id) in known:
+            app.logger.warning(f"[{crypto.crypto}/{txid}] TX already exist in db")
+            continue
+        known.add((txid, invoice.id))
+
+        rate, recalc_rate = rates[invoice.id]
+        tx = Transaction.add(
+            crypto,
+            {
+                "txid": txid,
+                "addr": addr,
+                "amount": amount,
+                "confirmations": confirmations,
+            },
+            invoice=invoice,
+            commit=False,
+            rate=rate,
+        )
+        db.session.flush()
+        tx.invoice.update_with_tx(tx, commit=False, rate=recalc_rate)
+        UnconfirmedTransaction.delete(crypto_name, txid, commit=False)
+        added.append(txid)
+        if not tx.need_more_confirmations:
+            settle_commission(tx)
+            confirmed.append(tx)
+    db.session.commit()
+    app.logger.info(f"[{crypto.crypto}] {len(added)} TXs have been added to db")
+
+    not_related = [
+        txid for txid in dict.fromkeys(not_related) if txid not in related
+    ]
+    for txid in not_related:
+        if all(row[2] > 0 for row in details[txid]):
+            seen_transactions.unrelated(crypto_name, txid)
+
+    for utx in unconfirmed:
+        notify_unconfirmed(utx)
+    for tx in confirmed:
+        notify(tx)
+    return {
+        "added": added,
+        "skipped": skipped,
+        "not_related": not_related,
+        "failed": [txid for txid in lookup if txid not in found],
+    }
+
+
+def process_queued(entry_id):
+    """Process a queued notification.
+
+    Returns True if it was notified again meanwhile and has to run once more.
+    """
+    entry = WalletNotification.query.get(entry_id)
+    if entry is None:
+        return False
+
+    received = entry.received
+    crypto_name, txid = entry.crypto, entry.txid
+    try:
+        if crypto_name in Crypto.instances:
+            process_walletnotify(crypto_name, txid)
+    except NotRelatedToAnyInvoice:
+        app.logger.warning(f"Transaction {txid} is not related to any invoice")
+    except Exception:
+        app.logger.exception(
+            f"Exception while processing transaction notification: {crypto_name}/{txid}"
+        )
+        db.session.rollback()
+        WalletNotification.query.get(entry_id).schedule_retry(traceback.format_exc())
+        return False
+
+    return not WalletNotification.query.get(entry_id).finish(received)
+
+
+class WalletnotifyWorkers:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._in_flight = set()
+
+    def executor(self, app):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=app.config["WALLETNOTIFY_WORKERS"],
+                thread_name_prefix="walletnotify",
+            )
+        return self._executor
+
+    def submit(self, app, entry_id):
+        """Process the queue entry in a worker unless one is already on it."""
+        with self._lock:
+            if entry_id in self._in_flight:
+                return
+            self._in_flight.add(entry_id)
+            self.executor(app).submit(self._run, app, entry_id)
+
+    def _run(self, app, entry_id):
+        try:
+            again = True
+            while again:
+                with app.app_context():
+                    again = process_queued(entry_id)
+        except Exception:
+            app.logger.exception(f"Walletnotify worker failed on entry {entry_id}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(entry_id)
+
+
+walletnotify_workers = WalletnotifyWorkers()
+
+
+def process_due():
+    """Hand due queue entries to the workers."""
+    for entry in WalletNotification.due(app.config["WALLETNOTIFY_SWEEP_BATCH"]):
+        walletnotify_workers.submit(app._get_current_object(), entry.id)
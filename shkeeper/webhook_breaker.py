@@ -0,0 +1,128 @@
+"""
+Webhook Circuit Breaker
+
+Tracks delivery failures per callback host. After WEBHOOK_BREAKER_THRESHOLD
+consecutive failures (connection errors, timeouts or HTTP 5xx) the breaker
+opens and deliveries to that host are postponed without a request. Once
+WEBHOOK_BREAKER_COOLDOWN seconds have passed a single probe delivery is let
+through (half-open): success closes the breaker, failure opens it again.
+A probe that reports neither within another cooldown is given up and the
+next delivery becomes the probe.
+
+State is kept in memory and exported to /metrics.
+"""
+
+import threading
+import time
+
+import prometheus_client
+from flask import current_app as app
+
+from shkeeper.webhook_dispatcher import destination_host
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+breaker_state = prometheus_client.Gauge(
+    "shkeeper_webhook_breaker_state",
+    "Webhook circuit breaker state per host (0 closed, 1 half-open, 2 open)",
+    ["host"],
+)
+breaker_trips = prometheus_client.Counter(
+    "shkeeper_webhook_breaker_trips_total",
+    "Times the webhook circuit breaker opened for a host",
+    ["host"],
+)
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class Breaker:
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+        self.last_error = None
+
+
+class WebhookBreakers:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def _get(self, host):
+        if host not in self._breakers:
+            self._breakers[host] = Breaker()
+        return self._breakers[host]
+
+    def _set_state(self, host, breaker, state):
+        breaker.state = state
+        breaker_state.labels(host).set(STATE_VALUES[state])
+
+    def allow(self, url):
+        """True if a delivery to url may be attempted now."""
+        host = destination_host(url)
+        with self._lock:
+            breaker = self._get(host)
+            if breaker.state == CLOSED:
+                return True
+            if self.retry_in(url) == 0:
+                # let exactly one probe through
+                breaker.probe_at = time.monotonic()
+                self._set_state(host, breaker, HALF_OPEN)
+                return True
+            return False
+
+    def retry_in(self, url):
+        """Seconds until an open breaker lets a probe through, or a
+        half-open one gives up on its probe and lets another through."""
+        breaker = self._breakers.get(destination_host(url))
+        if not breaker or breaker.state == CLOSED:
+            return 0
+        since = breaker.opened_at if breaker.state == OPEN else breaker.probe_at
+        elapsed = time.monotonic() - since
+        return max(app.config["WEBHOOK_BREAKER_COOLDOWN"] - elapsed, 0)
+
+    def record_success(self, url):
+        host = destination_host(url)
+        with self._lock:
+            breaker = self._get(host)
+            breaker.failures = 0
+            breaker.last_error = None
+            if breaker.state != CLOSED:
+                app.logger.info(f"[Webhook] Circuit breaker for {host} closed")
+                self._set_state(host, breaker, CLOSED)
+
+    def record_failure(self, url, error):
+        host = destination_host(url)
+        with self._lock:
+            breaker = self._get(host)
+            breaker.failures += 1
+            breaker.last_error = error
+            if breaker.state == HALF_OPEN or (
+                breaker.state == CLOSED
+                and breaker.failures >= app.config["WEBHOOK_BREAKER_THRESHOLD"]
+            ):
+                app.logger.warning(
+                    f"[Webhook] Circuit breaker for {host} opened after "
+                    f"{breaker.failures} consecutive failures: {error}"
+                )
+                breaker.opened_at = time.monotonic()
+                breaker_trips.labels(host).inc()
+                self._set_state(host, breaker, OPEN)
+
+    def status(self, url):
+        host = destination_host(url)
+        breaker = self._breakers.get(host) or Breaker()
+        return {
+            "host": host,
+            "state": breaker.state,
+            "failures": breaker.failures,
+            "last_error": breaker.last_error,
+            "retry_in": round(self.retry_in(url)),
+        }
+
+
+webhook_breakers = WebhookBreakers()
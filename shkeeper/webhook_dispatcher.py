@@ -0,0 +1,99 @@
+"""
+Webhook Dispatcher
+
+Delivers merchant notifications concurrently from a bounded worker pool.
+
+Deliveries are queued per destination host and every host is drained by at
+most WEBHOOK_HOST_CONCURRENCY workers, so a slow or dead endpoint can hold a
+few workers for the length of REQUESTS_NOTIFICATION_TIMEOUT but never the
+whole pool. A dispatch cycle waits at most WEBHOOK_CYCLE_DEADLINE seconds;
+deliveries not started by then are dropped and picked up by the next cycle,
+deliveries still running keep going and are not queued twice.
+
+Every job runs inside its own app context, which gives the worker thread its
+own scoped SQLAlchemy session (removed on context teardown). Jobs receive row
+ids, not ORM objects, and load what they need in that session.
+"""
+
+import threading
+import time
+from collections import Counter, defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+
+WebhookJob = namedtuple("WebhookJob", "key url func args")
+
+
+def destination_host(url):
+    return urlparse(url or "").netloc.lower()
+
+
+class WebhookDispatcher:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._queues = defaultdict(deque)
+        self._runners = Counter()
+        self._in_flight = set()
+
+    def executor(self, app):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=app.config["WEBHOOK_WORKERS"],
+                thread_name_prefix="webhook",
+            )
+        return self._executor
+
+    def submit(self, app, job):
+        """Queue a single delivery without waiting for it."""
+        self.dispatch(app, [job], block=False)
+
+    def dispatch(self, app, jobs, block=True):
+        """Queue jobs and wait until they are done or the cycle deadline passed.
+
+        Returns the number of jobs that were queued.
+        """
+        deadline = time.monotonic() + app.config["WEBHOOK_CYCLE_DEADLINE"]
+        limit = app.config["WEBHOOK_HOST_CONCURRENCY"]
+        queued = []
+        with self._lock:
+            for job in jobs:
+                if job.key in self._in_flight:
+                    continue
+                self._in_flight.add(job.key)
+                done = threading.Event()
+                host = destination_host(job.url)
+                self._queues[host].append((job, deadline, done))
+                queued.append(done)
+                if self._runners[host] < limit:
+                    self._runners[host] += 1
+                    self.executor(app).submit(self._drain, app, host)
+
+        if block:
+            for done in queued:
+                if not done.wait(max(deadline - time.monotonic(), 0)):
+                    break
+        return len(queued)
+
+    def _drain(self, app, host):
+        while True:
+            with self._lock:
+                if not self._queues[host]:
+                    self._runners[host] -= 1
+                    del self._queues[host]
+                    return
+                job, deadline, done = self._queues[host].popleft()
+            try:
+                if time.monotonic() < deadline:
+                    with app.app_context():
+                        job.func(*job.args)
+            except Exception:
+                app.logger.exception(f"Webhook delivery {job.key} to {host} failed")
+            finally:
+                with self._lock:
+                    self._in_flight.discard(job.key)
+                done.set()
+
+
+webhook_dispatcher = WebhookDispatcher()
@@ -0,0 +1,71 @@
+"""
+Webhook Timer
+
+In-process delayed delivery: schedule() puts a webhook job on a heap ordered
+by due time and a single timer thread hands each job to the webhook
+dispatcher the moment it becomes due, instead of waiting for the next
+callback task tick.
+
+The heap is not persistent. Outbox rows keep their next_attempt_at, so the
+periodic callback task picks up whatever was scheduled here before a restart.
+"""
+
+import heapq
+import itertools
+import threading
+from datetime import datetime
+
+from shkeeper.webhook_dispatcher import webhook_dispatcher
+
+
+class WebhookTimer:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []
+        self._due = {}
+        self._seq = itertools.count()
+        self._thread = None
+
+    def __contains__(self, key):
+        return key in self._due
+
+    def schedule(self, app, job, at):
+        """Dispatch job at datetime at (right away if it is already due).
+
+        Scheduling a key again replaces its previous due time.
+        """
+        with self._cond:
+            if self._due.get(job.key) == at:
+                return
+            self._due[job.key] = at
+            heapq.heappush(self._heap, (at, next(self._seq), app, job))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self.run, name="WebhookTimer", daemon=True
+                )
+                self._thread.start()
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                at, _, app, job = self._heap[0]
+                wait = (at - datetime.now()).total_seconds()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._heap)
+                if self._due.get(job.key) != at:
+                    # rescheduled, a later heap entry is the current one
+                    continue
+                del self._due[job.key]
+
+            try:
+                webhook_dispatcher.submit(app, job)
+            except Exception:
+                app.logger.exception(f"Failed to dispatch webhook {job.key}")
+
+
+webhook_timer = WebhookTimer()